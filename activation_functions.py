@@ -1,6 +1,8 @@
 import torch
+import torch.nn as nn
 import torch.nn.functional as F
 from torch import logsumexp
+from torch.autograd.function import once_differentiable
 import util
 
 import math
@@ -14,77 +16,145 @@ def activate(x, actfun, p=1, k=1, M=None,
              shuffle_maps=None,
              alpha_primes=None,
              alpha_dist=None,
-             reduce_actfuns=False
+             reduce_actfuns=False,
+             perm_index=None,
+             combinact_recompute=False
              ):
 
     if permute_type == 'invert':
         assert p % k == 0, 'k must divide p if you use the invert shuffle type ya big dummy.'
 
-    # Unsqueeze a dimension and populate it with permutations of our inputs
-    x = x.unsqueeze(2)
-    curr_permute = permute_type
-    permute_base = 0
-    for i in range(1, p):
-        curr_shuffle = shuffle_maps[i]
-        if permute_type == 'invert':
-            if i % k == 0:
-                curr_permute = 'shuffle'
-                permute_base = 0
-            else:
-                curr_permute = 'invert'
-                permute_base = x.shape[2] - 1
-                curr_shuffle = torch.arange(k)
-                curr_shuffle[0] = i % k
-                curr_shuffle[i % k] = 0
-        permutation = util.permute(x[:, :, permute_base, ...], curr_permute, layer_type, k,
-                                   offset=i, shuffle_map=curr_shuffle).unsqueeze(2)
-        x = torch.cat((x[:, :, :i, ...], permutation), dim=2)
-
-    # This transpose makes it so that during the next reshape (when we combine our p permutations
-    # into a single dimension), the order goes one full permutation after another (instead of
-    # interleaving the permutations)
-    x = torch.transpose(x, dim0=1, dim1=2)
-
-    # Combine p permutations into a single dimension, then cluster into groups of size k
+    # Gather all p permutations of our inputs in one pass. The index lays them out one full permutation
+    # after another (instead of interleaving the permutations), so that the next reshape clusters each
+    # permutation separately
     batch_size = x.shape[0]
+    num_channels = M if layer_type == 'linear' else x.shape[1]
+    if actfun in _FUSED_ACTFUNS and k > 1 and not is_compiling():
+        if p == 1:
+            perm_index = torch.arange(num_channels)
+        elif perm_index is None:
+            perm_index = util.get_perm_index(shuffle_maps, p, k, permute_type)
+        check_perm_index(perm_index, x, p)
+        return fused_group_reduce(x, perm_index.to(x.device).view(-1, k), actfun)
+    if p > 1:
+        if perm_index is None:
+            perm_index = util.get_perm_index(shuffle_maps, p, k, permute_type)
+        x = x.index_select(1, perm_index.to(x.device))
+
+    # Cluster into groups of size k
     if layer_type == 'conv':
-        num_channels = x.shape[2]
-        height = x.shape[3]
-        width = x.shape[4]
+        height = x.shape[2]
+        width = x.shape[3]
         x = x.reshape(batch_size, int(num_channels * p / k), k, height, width)
     elif layer_type == 'linear':
-        num_channels = M
         x = x.reshape(batch_size, int(num_channels * p / k), k)
 
-    bin_partition_actfuns = ['bin_part_full', 'bin_part_max_min_sgm', 'bin_part_max_sgm',
-                             'ail_part_full', 'ail_part_or_and_xnor', 'ail_part_or_xnor']
-    bin_all_actfuns = ['bin_all_full', 'bin_all_max_min', 'bin_all_max_sgm', 'bin_all_max_min_sgm',
-                       'ail_all_full', 'ail_all_or_and', 'ail_all_or_xnor', 'ail_all_or_and_xnor']
-
+    return get_activation_fn(actfun, p, k, layer_type, alpha_dist, reduce_actfuns,
+                             combinact_recompute)(x, alpha_primes)
+
+
+def get_activation_fn(actfun, p, k, layer_type='conv', alpha_dist=None, reduce_actfuns=False,
+                      combinact_recompute=False):
+    """
+    Resolves an activation function name into a function of (z, alpha_primes), where z holds the clustered
+    pre-activations of shape (batch, clusters, k, ...)
+    :param actfun: activation function name
+    :param p: number of permutations
+    :param k: group size
+    :param layer_type: 'conv' or 'linear'
+    :param alpha_dist: alpha distribution used by combinact
+    :param reduce_actfuns: whether combinact uses the reduced set of activation functions
+    :param combinact_recompute: whether combinact recomputes its activation functions in the backward pass
+        instead of storing them
+    :return: activation function
+    """
     if actfun == 'combinact':
-        x = combinact(x,
-                      p=p,
-                      layer_type=layer_type,
-                      alpha_primes=alpha_primes,
-                      alpha_dist=alpha_dist,
-                      reduce_actfuns=reduce_actfuns)
+        return lambda z, alpha_primes=None: combinact(z,
+                                                      p=p,
+                                                      layer_type=layer_type,
+                                                      alpha_primes=alpha_primes,
+                                                      alpha_dist=alpha_dist,
+                                                      reduce_actfuns=reduce_actfuns,
+                                                      recompute=combinact_recompute)
     elif actfun == 'cf_relu' or actfun == 'cf_abs':
-        x = coin_flip(x, actfun, M=num_channels * p, k=k)
-    elif actfun in bin_partition_actfuns or actfun in bin_all_actfuns:
-        x = binary_ops(x, actfun, layer_type, bin_partition_actfuns, bin_all_actfuns)
+        return lambda z, alpha_primes=None: coin_flip(z, actfun, M=z.shape[1] * k, k=k)
+    elif actfun in _BIN_PARTITION_ACTFUNS or actfun in _BIN_ALL_ACTFUNS:
+        return lambda z, alpha_primes=None: binary_ops(z, actfun, layer_type,
+                                                       _BIN_PARTITION_ACTFUNS, _BIN_ALL_ACTFUNS)
     elif actfun == 'groupsort':
-        x = groupsort(x, layer_type)
+        return lambda z, alpha_primes=None: groupsort(z, layer_type)
+    elif k == 1:
+        return lambda z, alpha_primes=None: _ACTFUNS[actfun](z.squeeze(2))
     else:
-        x = x.squeeze()
-        x = _ACTFUNS[actfun](x)
+        return lambda z, alpha_primes=None: _ACTFUNS[actfun](z)
 
-    return x
+
+class HigherOrderActivation(nn.Module):
+    """
+    Higher order activation for a single layer. The shuffle maps, permutation gather index and activation
+    function are resolved once at construction, so the forward pass only gathers, clusters and reduces.
+    """
+
+    def __init__(self, actfun, num_nodes, p=1, k=1,
+                 layer_type='conv',
+                 permute_type='shuffle',
+                 alpha_dist=None,
+                 reduce_actfuns=False,
+                 combinact_recompute=False):
+        super(HigherOrderActivation, self).__init__()
+
+        if permute_type == 'invert':
+            assert p % k == 0, 'k must divide p if you use the invert shuffle type ya big dummy.'
+
+        self.actfun = actfun
+        self.p, self.k = p, k
+        self.layer_type = layer_type
+        self.permute_type = permute_type
+
+        shuffle_maps = util.add_shuffle_map([], num_nodes, p)[0]
+        self.register_buffer('shuffle_maps', shuffle_maps)
+        self.register_buffer('perm_index', util.get_perm_index(shuffle_maps, p, k, permute_type), persistent=False)
+
+        self.expand = self.gather_permutations if p > 1 else nn.Identity()
+        self.fused = actfun in _FUSED_ACTFUNS and k > 1
+        self.actfun_fn = get_activation_fn(actfun, p, k, layer_type, alpha_dist, reduce_actfuns,
+                                           combinact_recompute)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # Checkpoints saved before the shuffle maps were persisted don't contain them, in which case we keep
+        # the maps drawn from the seed at construction
+        if prefix + 'shuffle_maps' not in state_dict:
+            state_dict[prefix + 'shuffle_maps'] = self.shuffle_maps
+        super(HigherOrderActivation, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                                 missing_keys, unexpected_keys, error_msgs)
+        self.perm_index = util.get_perm_index(self.shuffle_maps, self.p, self.k, self.permute_type)
+
+    def gather_permutations(self, x):
+        return x.index_select(1, self.perm_index)
+
+    def forward(self, x, alpha_primes=None):
+        if self.fused and not is_compiling():
+            check_perm_index(self.perm_index, x, self.p)
+            return fused_group_reduce(x, self.perm_index.view(-1, self.k), self.actfun)
+        x = self.expand(x)
+        x = x.reshape(x.shape[0], -1, self.k, *x.shape[2:])
+        return self.actfun_fn(x, alpha_primes)
+
+    def extra_repr(self):
+        return 'actfun={}, p={}, k={}, layer_type={}, permute_type={}'.format(
+            self.actfun, self.p, self.k, self.layer_type, self.permute_type)
 
 
 # -------------------- Activation Functions
 
 _COMBINACT_ACTFUNS = ['max', 'swishk', 'l1', 'l2', 'linf', 'lse', 'lae', 'min', 'nlsen', 'nlaen', 'signed_geomean']
 _COMBINACT_ACTFUNS_REDUCED = ['max', 'swishk', 'l2', 'lae', 'signed_geomean']
+_FUSED_ACTFUNS = ['max', 'min', 'linf', 'lse', 'lae', 'l2']
+_BIN_PARTITION_ACTFUNS = ['bin_part_full', 'bin_part_max_min_sgm', 'bin_part_max_sgm',
+                          'ail_part_full', 'ail_part_or_and_xnor', 'ail_part_or_xnor']
+_BIN_ALL_ACTFUNS = ['bin_all_full', 'bin_all_max_min', 'bin_all_max_sgm', 'bin_all_max_min_sgm',
+                    'ail_all_full', 'ail_all_or_and', 'ail_all_or_xnor', 'ail_all_or_and_xnor']
 
 
 def get_combinact_actfuns(reduce_actfuns=False):
@@ -175,70 +245,86 @@ def logistic_xnor_approx(z):
     return torch.sign(torch.prod(z, dim=2)) * torch.min(z.abs(), dim=2).values
 
 
-def combinact(x, p, layer_type='linear', alpha_primes=None, alpha_dist=None, reduce_actfuns=False):
+def combinact(x, p, layer_type='linear', alpha_primes=None, alpha_dist=None, reduce_actfuns=False, recompute=False):
 
     if reduce_actfuns:
         all_actfuns = _COMBINACT_ACTFUNS_REDUCED
     else:
         all_actfuns = _COMBINACT_ACTFUNS
 
-    # Recording current input shape
-    batch_size = x.shape[0]
-    num_clusters = x.shape[1]
-    img_size = x.shape[-1]
-
-    # print(alpha_primes.shape)
     layer_alphas = F.softmax(alpha_primes, dim=1)  # Convert alpha prime to alpha
 
-    # Computing all activation functions
-    outputs = None
-    for i, actfun in enumerate(all_actfuns):
-        if i == 0:
-            outputs = _ACTFUNS[actfun](x).to(x.device)
-            outputs = outputs.unsqueeze(dim=2)
-        else:
-            outputs = torch.cat((outputs, _ACTFUNS[actfun](x).unsqueeze(dim=2)), dim=2)
-
-    # Handling per-permutation alpha vector
+    # Handling per-permutation alpha vector: every p-th cluster shares the same alphas
     if alpha_dist == "per_perm":
-        if layer_type == 'conv':
-            layer_alphas = layer_alphas.reshape([1, 1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1],
-                                                 1, 1])
-            outputs = outputs.reshape([batch_size, int(num_clusters / p), p,
-                                       len(all_actfuns), img_size, img_size])
+        layer_alphas = layer_alphas.repeat(int(x.shape[1] / p), 1)
 
-        elif layer_type == 'linear':
-            layer_alphas = layer_alphas.reshape([1, 1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1]])
-            outputs = outputs.reshape([batch_size, int(num_clusters / p), p,
-                                       len(all_actfuns)])
-        outputs = outputs * layer_alphas  # Multiply elements in last 2 dims of outputs by layer_alphas
-        outputs = torch.sum(outputs, dim=3)  # Sum across all actfuns
+    # Broadcast the per-cluster alphas over the batch and image dimensions
+    layer_alphas = layer_alphas.reshape(1, layer_alphas.shape[0], layer_alphas.shape[1], *([1] * (x.dim() - 3)))
 
-        if layer_type == 'conv':
-            outputs = outputs.reshape([batch_size, num_clusters, img_size, img_size])
-        elif layer_type == 'linear':
-            outputs = outputs.reshape([batch_size, num_clusters])
+    # The recomputing backward pass cannot be traced by torch.compile, which rematerializes the basis itself
+    if recompute and not is_compiling():
+        return CombinactRecompute.apply(x, layer_alphas, all_actfuns)
+    return combinact_reduce(x, layer_alphas, all_actfuns)
 
-    # Handling per-cluster alpha vector
-    elif alpha_dist == "per_cluster":
-        if layer_type == 'conv':
-            layer_alphas = layer_alphas.reshape([1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1],
-                                                 1, 1])
-        elif layer_type == 'linear':
-            layer_alphas = layer_alphas.reshape([1,
-                                                 layer_alphas.shape[0], layer_alphas.shape[1]])
 
-        outputs = outputs * layer_alphas  # Multiply elements in last 2 dims of outputs by layer_alphas
-        outputs = torch.sum(outputs, dim=2)  # Sum across all actfuns
+def is_compiling():
+    compiler = getattr(torch, 'compiler', None)
+    return compiler is not None and compiler.is_compiling()
+
+
+def combinact_reduce(x, layer_alphas, all_actfuns):
+    """
+    Accumulates the alpha weighted sum of all combinact activation functions
+    :param x: clustered inputs of shape (batch, clusters, k, ...)
+    :param layer_alphas: alphas of shape (1, clusters, len(all_actfuns), 1, ...)
+    :param all_actfuns: names of the activation functions to combine
+    :return: tensor of shape (batch, clusters, ...)
+    """
+    outputs = None
+    for i, actfun_output in enumerate(combinact_basis(x, all_actfuns)):
+        weighted_output = actfun_output * layer_alphas[:, :, i]
+        if outputs is None:
+            outputs = weighted_output
+        else:
+            outputs += weighted_output
 
     return outputs
 
 
+def combinact_basis(x, all_actfuns):
+    """
+    Yields the output of every combinact activation function on clustered inputs, in order. The reductions
+    that several of them share (max, min, lse and nlsen) are only computed once
+    :param x: clustered inputs of shape (batch, clusters, k, ...)
+    :param all_actfuns: names of the activation functions to evaluate
+    :return: generator of tensors of shape (batch, clusters, ...)
+    """
+    log_k = math.log(x.shape[2])
+    z_max = torch.max(x, dim=2).values if 'max' in all_actfuns or 'linf' in all_actfuns else None
+    z_min = torch.min(x, dim=2).values if 'min' in all_actfuns or 'linf' in all_actfuns else None
+    z_lse = torch.logsumexp(x, dim=2) if 'lse' in all_actfuns or 'lae' in all_actfuns else None
+    z_nlsen = -torch.logsumexp(-x, dim=2) if 'nlsen' in all_actfuns or 'nlaen' in all_actfuns else None
+
+    basis = {
+        'max': lambda: z_max,
+        'min': lambda: z_min,
+        'linf': lambda: torch.max(z_max, -z_min),
+        'lse': lambda: z_lse,
+        'lae': lambda: z_lse - log_k,
+        'nlsen': lambda: z_nlsen,
+        'nlaen': lambda: z_nlsen + log_k,
+        'l1': lambda: torch.sum(x.abs(), dim=2),
+        'l2': lambda: torch.sum(x.pow(2), dim=2).sqrt_(),
+        'swishk': lambda: x[:, :, 0] * torch.exp(torch.sum(F.logsigmoid(x), dim=2)),
+        'signed_geomean': lambda: sgm(x),
+    }
+
+    for actfun in all_actfuns:
+        yield basis[actfun]()
+
+
 def coin_flip(z, actfun, M, k):
-    shuffle_map = torch.empty(int(M / k), dtype=torch.long).random_(k)
+    shuffle_map = torch.randint(k, (int(M / k),))
     z = z[:, torch.arange(z.size(1)), shuffle_map, ...]
     if actfun == 'cf_relu':
         return F.relu_(z)
@@ -262,27 +348,162 @@ def groupsort(z, layer_type):
 
 
 class SignedGeomean(torch.autograd.Function):
+    """
+    Signed square root of the product over the k dimension. The magnitude is computed in log-space, as a sum
+    of log|x|, so large k does not overflow or underflow the product. The sign is the parity of the number of
+    negative inputs.
+    """
     @staticmethod
     def forward(ctx, input):
-        ctx.save_for_backward(input)
-        prod = torch.prod(input, dim=2)
-        signs = prod.sign()
-        return signs * prod.abs().sqrt()
+        num_negative = torch.sum(input < 0, dim=2)
+        signs = 1 - 2 * torch.remainder(num_negative, 2).to(input.dtype)
+        output = signs * torch.exp(0.5 * torch.sum(torch.log(input.abs()), dim=2))
+        ctx.save_for_backward(input, output)
+        return output
 
     @staticmethod
     def backward(ctx, grad_output):
-        input, = ctx.saved_tensors
+        input, output, = ctx.saved_tensors
 
-        prod = input.prod(dim=2).unsqueeze(2)
-        signs = prod.sign()
+        # d/dx_i sign(prod) * sqrt(|prod|) = output / (2 * x_i), which we define as 0 where x_i = 0
+        grad_input = (0.5 * grad_output * output).unsqueeze(2) / input
+        grad_input.masked_fill_(input == 0, 0)
 
-        A = (prod.expand(input.shape) / input).abs().sqrt() * input
-        B = 2 * input.abs().pow(3 / 2)
+        return grad_input
 
-        grad_input = signs * A / B * grad_output.unsqueeze(2).expand(input.shape)
-        grad_input[input.abs() == 0] = 0
 
-        return grad_input
+class CombinactRecompute(torch.autograd.Function):
+    """
+    Combinact reduction that only saves its inputs and alphas for the backward pass, and recomputes the
+    activation function outputs there. Only one layer's intermediates are alive at a time, at the cost of
+    evaluating the activation functions twice.
+    """
+    @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda')
+    def forward(ctx, input, layer_alphas, all_actfuns):
+        ctx.save_for_backward(input, layer_alphas)
+        ctx.all_actfuns = all_actfuns
+        return combinact_reduce(input, layer_alphas, all_actfuns)
+
+    @staticmethod
+    @once_differentiable
+    @torch.amp.custom_bwd(device_type='cuda')
+    def backward(ctx, grad_output):
+        input, layer_alphas = ctx.saved_tensors
+        sum_dims = [0] + list(range(2, grad_output.dim()))
+
+        with torch.enable_grad():
+            input = input.detach().requires_grad_()
+            layer_alphas = layer_alphas.detach()
+            outputs = None
+            grad_alphas = []
+            for i, actfun_output in enumerate(combinact_basis(input, ctx.all_actfuns)):
+                grad_alphas.append(torch.sum(grad_output * actfun_output.detach(), dim=sum_dims))
+                weighted_output = actfun_output * layer_alphas[:, :, i]
+                if outputs is None:
+                    outputs = weighted_output
+                else:
+                    outputs += weighted_output
+            grad_input, = torch.autograd.grad(outputs, input, grad_output)
+
+        grad_alphas = torch.stack(grad_alphas, dim=1).reshape(layer_alphas.shape)
+
+        return grad_input, grad_alphas, None
+
+
+class FusedGroupReduce(torch.autograd.Function):
+    """
+    Gathers and reduces the clusters of k pre-activations one cluster element at a time, so the permuted and
+    clustered tensor of p * M pre-activations is never allocated, only tensors the size of the output. Only the
+    pre-activations and the output are saved, and the backward pass regathers the cluster elements from them to
+    scatter the gradient straight back: for max, min and linf into the first selected element of each cluster, and
+    for lse, lae and l2 weighted by each element's share of the reduction.
+    """
+    @staticmethod
+    @torch.amp.custom_fwd(device_type='cuda')
+    def forward(ctx, input, cluster_index, actfun):
+        k = cluster_index.shape[1]
+        ctx.actfun = actfun
+        columns = (input.index_select(1, cluster_index[:, i]) for i in range(k))
+
+        if actfun == 'l2':
+            output = next(columns).pow_(2)
+            for column in columns:
+                output.addcmul_(column, column)
+            output = output.sqrt_()
+        elif actfun == 'min':
+            output = next(columns)
+            for column in columns:
+                output = torch.minimum(output, column, out=output)
+        else:
+            output = next(columns)
+            output = output.abs_() if actfun == 'linf' else output
+            for column in columns:
+                output = torch.maximum(output, column.abs_() if actfun == 'linf' else column, out=output)
+            if actfun == 'lse' or actfun == 'lae':
+                # Summed in at least float32 as logavgexp does, so mixed precision runs keep its precision
+                dtype = torch.promote_types(input.dtype, torch.float32)
+                z_max = output.to(dtype)
+                output = torch.zeros_like(z_max)
+                for i in range(k):
+                    output += input.index_select(1, cluster_index[:, i]).to(dtype).sub_(z_max).exp_()
+                output = output.log_().add_(z_max)
+
+        ctx.save_for_backward(input, cluster_index, output)
+        if actfun == 'lae':
+            output = output - math.log(k)
+        return output.to(input.dtype)
+
+    @staticmethod
+    @once_differentiable
+    @torch.amp.custom_bwd(device_type='cuda')
+    def backward(ctx, grad_output):
+        input, cluster_index, output = ctx.saved_tensors
+        actfun = ctx.actfun
+        k = cluster_index.shape[1]
+        grad_input = torch.zeros_like(input, dtype=grad_output.dtype)
+
+        if actfun == 'l2':
+            grad_output = grad_output / output
+        for i in range(k):
+            column = input.index_select(1, cluster_index[:, i])
+            if actfun == 'l2':
+                grad_column = grad_output * column
+            elif actfun == 'lse' or actfun == 'lae':
+                grad_column = (grad_output * column.to(output.dtype).sub_(output).exp_()).to(grad_input.dtype)
+            else:
+                # The gradient left over by the earlier elements goes to the first one that equals the output
+                if i < k - 1:
+                    selected = torch.eq(column.abs() if actfun == 'linf' else column, output).to(grad_output.dtype)
+                    grad_column = grad_output * selected
+                    grad_output = grad_output - grad_column
+                else:
+                    grad_column = grad_output
+                if actfun == 'linf':
+                    grad_column = grad_column * column.sign_()
+            grad_input.index_add_(1, cluster_index[:, i], grad_column)
+        return grad_input, None, None
+
+
+def check_perm_index(perm_index, x, p):
+    """
+    Raises a ValueError unless the permutation gather index covers all the channels of x, p times. The fused
+    reductions would otherwise silently drop or repeat channels
+    """
+    if perm_index.numel() != x.shape[1] * p:
+        raise ValueError('Permutation index of size {} does not match {} input channels and p = {}, the '
+                         'activation was built for {} nodes'.format(perm_index.numel(), x.shape[1], p,
+                                                                    perm_index.numel() // p))
+
+
+def fused_group_reduce(input, cluster_index, actfun):
+    """
+    :param input: pre-activations of shape (batch, M, ...)
+    :param cluster_index: LongTensor of shape (M * p / k, k), the channels of input in each cluster
+    :param actfun: max, min, linf, lse, lae or l2
+    :return: tensor of shape (batch, M * p / k, ...)
+    """
+    return FusedGroupReduce.apply(input, cluster_index, actfun)
 
 
 def signed_l3(z):
@@ -1,6 +1,57 @@
 from PIL import Image, ImageEnhance, ImageOps
 import numpy as np
 import random
+import torch
+import torch.nn.functional as F
+
+RANGES = {
+    "shearX": np.linspace(0, 0.3, 10),
+    "shearY": np.linspace(0, 0.3, 10),
+    "translateX": np.linspace(0, 150 / 331, 10),
+    "translateY": np.linspace(0, 150 / 331, 10),
+    "rotate": np.linspace(0, 30, 10),
+    "color": np.linspace(0.0, 0.9, 10),
+    "posterize": np.round(np.linspace(8, 4, 10), 0).astype(int),
+    "solarize": np.linspace(256, 0, 10),
+    "contrast": np.linspace(0.0, 0.9, 10),
+    "sharpness": np.linspace(0.0, 0.9, 10),
+    "brightness": np.linspace(0.0, 0.9, 10),
+    "autocontrast": [0] * 10,
+    "equalize": [0] * 10,
+    "invert": [0] * 10
+}
+
+CIFAR10_SUB_POLICIES = [
+    (0.1, "invert", 7, 0.2, "contrast", 6),
+    (0.7, "rotate", 2, 0.3, "translateX", 9),
+    (0.8, "sharpness", 1, 0.9, "sharpness", 3),
+    (0.5, "shearY", 8, 0.7, "translateY", 9),
+    (0.5, "autocontrast", 8, 0.9, "equalize", 2),
+
+    (0.2, "shearY", 7, 0.3, "posterize", 7),
+    (0.4, "color", 3, 0.6, "brightness", 7),
+    (0.3, "sharpness", 9, 0.7, "brightness", 9),
+    (0.6, "equalize", 5, 0.5, "equalize", 1),
+    (0.6, "contrast", 7, 0.6, "sharpness", 5),
+
+    (0.7, "color", 7, 0.5, "translateX", 8),
+    (0.3, "equalize", 7, 0.4, "autocontrast", 8),
+    (0.4, "translateY", 3, 0.2, "sharpness", 6),
+    (0.9, "brightness", 6, 0.2, "color", 8),
+    (0.5, "solarize", 2, 0.0, "invert", 3),
+
+    (0.2, "equalize", 0, 0.6, "autocontrast", 0),
+    (0.2, "equalize", 8, 0.6, "equalize", 4),
+    (0.9, "color", 9, 0.6, "equalize", 6),
+    (0.8, "autocontrast", 4, 0.2, "solarize", 8),
+    (0.1, "brightness", 3, 0.7, "color", 0),
+
+    (0.4, "solarize", 5, 0.9, "autocontrast", 3),
+    (0.9, "translateY", 9, 0.7, "translateY", 9),
+    (0.9, "autocontrast", 2, 0.8, "solarize", 3),
+    (0.8, "equalize", 8, 0.1, "invert", 3),
+    (0.7, "translateY", 9, 0.9, "autocontrast", 1)
+]
 
 
 class ImageNetPolicy(object):
@@ -73,37 +124,7 @@ class CIFAR10Policy(object):
     """
 
     def __init__(self, fillcolor=(128, 128, 128)):
-        self.policies = [
-            SubPolicy(0.1, "invert", 7, 0.2, "contrast", 6, fillcolor),
-            SubPolicy(0.7, "rotate", 2, 0.3, "translateX", 9, fillcolor),
-            SubPolicy(0.8, "sharpness", 1, 0.9, "sharpness", 3, fillcolor),
-            SubPolicy(0.5, "shearY", 8, 0.7, "translateY", 9, fillcolor),
-            SubPolicy(0.5, "autocontrast", 8, 0.9, "equalize", 2, fillcolor),
-
-            SubPolicy(0.2, "shearY", 7, 0.3, "posterize", 7, fillcolor),
-            SubPolicy(0.4, "color", 3, 0.6, "brightness", 7, fillcolor),
-            SubPolicy(0.3, "sharpness", 9, 0.7, "brightness", 9, fillcolor),
-            SubPolicy(0.6, "equalize", 5, 0.5, "equalize", 1, fillcolor),
-            SubPolicy(0.6, "contrast", 7, 0.6, "sharpness", 5, fillcolor),
-
-            SubPolicy(0.7, "color", 7, 0.5, "translateX", 8, fillcolor),
-            SubPolicy(0.3, "equalize", 7, 0.4, "autocontrast", 8, fillcolor),
-            SubPolicy(0.4, "translateY", 3, 0.2, "sharpness", 6, fillcolor),
-            SubPolicy(0.9, "brightness", 6, 0.2, "color", 8, fillcolor),
-            SubPolicy(0.5, "solarize", 2, 0.0, "invert", 3, fillcolor),
-
-            SubPolicy(0.2, "equalize", 0, 0.6, "autocontrast", 0, fillcolor),
-            SubPolicy(0.2, "equalize", 8, 0.6, "equalize", 4, fillcolor),
-            SubPolicy(0.9, "color", 9, 0.6, "equalize", 6, fillcolor),
-            SubPolicy(0.8, "autocontrast", 4, 0.2, "solarize", 8, fillcolor),
-            SubPolicy(0.1, "brightness", 3, 0.7, "color", 0, fillcolor),
-
-            SubPolicy(0.4, "solarize", 5, 0.9, "autocontrast", 3, fillcolor),
-            SubPolicy(0.9, "translateY", 9, 0.7, "translateY", 9, fillcolor),
-            SubPolicy(0.9, "autocontrast", 2, 0.8, "solarize", 3, fillcolor),
-            SubPolicy(0.8, "equalize", 8, 0.1, "invert", 3, fillcolor),
-            SubPolicy(0.7, "translateY", 9, 0.9, "autocontrast", 1, fillcolor)
-        ]
+        self.policies = [SubPolicy(*sub_policy, fillcolor=fillcolor) for sub_policy in CIFAR10_SUB_POLICIES]
 
     def __call__(self, img):
         policy_idx = random.randint(0, len(self.policies) - 1)
@@ -170,23 +191,6 @@ class SVHNPolicy(object):
 
 class SubPolicy(object):
     def __init__(self, p1, operation1, magnitude_idx1, p2, operation2, magnitude_idx2, fillcolor=(128, 128, 128)):
-        ranges = {
-            "shearX": np.linspace(0, 0.3, 10),
-            "shearY": np.linspace(0, 0.3, 10),
-            "translateX": np.linspace(0, 150 / 331, 10),
-            "translateY": np.linspace(0, 150 / 331, 10),
-            "rotate": np.linspace(0, 30, 10),
-            "color": np.linspace(0.0, 0.9, 10),
-            "posterize": np.round(np.linspace(8, 4, 10), 0).astype(np.int),
-            "solarize": np.linspace(256, 0, 10),
-            "contrast": np.linspace(0.0, 0.9, 10),
-            "sharpness": np.linspace(0.0, 0.9, 10),
-            "brightness": np.linspace(0.0, 0.9, 10),
-            "autocontrast": [0] * 10,
-            "equalize": [0] * 10,
-            "invert": [0] * 10
-        }
-
         # from https://stackoverflow.com/questions/5252170/specify-image-filling-color-when-rotating-in-python-with-pil-and-setting-expand
         def rotate_with_fill(img, magnitude):
             rot = img.convert("RGBA").rotate(magnitude)
@@ -222,12 +226,221 @@ class SubPolicy(object):
 
         self.p1 = p1
         self.operation1 = func[operation1]
-        self.magnitude1 = ranges[operation1][magnitude_idx1]
+        self.magnitude1 = RANGES[operation1][magnitude_idx1]
         self.p2 = p2
         self.operation2 = func[operation2]
-        self.magnitude2 = ranges[operation2][magnitude_idx2]
+        self.magnitude2 = RANGES[operation2][magnitude_idx2]
 
     def __call__(self, img):
         if random.random() < self.p1: img = self.operation1(img, self.magnitude1)
         if random.random() < self.p2: img = self.operation2(img, self.magnitude2)
-        return img
\ No newline at end of file
+        return img
+
+
+class BatchCIFAR10Policy(object):
+    """ Batched version of CIFAR10Policy, applied to uint8 tensors of shape (N, 3, H, W) on their own device.
+        Each image draws its own Sub-policy, and the same operations, probabilities and magnitudes are used.
+
+        Example:
+        >>> policy = BatchCIFAR10Policy()
+        >>> transformed = policy(images)
+    """
+
+    def __init__(self, fillcolor=(128, 128, 128)):
+        self.fillcolor = fillcolor
+        self.operations = sorted(set(sub_policy[i] for sub_policy in CIFAR10_SUB_POLICIES for i in (1, 4)))
+        self.stages = []
+        for p_idx, operation_idx, magnitude_idx in [(0, 1, 2), (3, 4, 5)]:
+            self.stages.append((
+                torch.tensor([sub_policy[p_idx] for sub_policy in CIFAR10_SUB_POLICIES]),
+                torch.tensor([self.operations.index(sub_policy[operation_idx])
+                              for sub_policy in CIFAR10_SUB_POLICIES]),
+                torch.tensor([float(RANGES[sub_policy[operation_idx]][sub_policy[magnitude_idx]])
+                              for sub_policy in CIFAR10_SUB_POLICIES])
+            ))
+
+    def __call__(self, images):
+        num_images, device = images.shape[0], images.device
+        policy_idx = torch.randint(len(CIFAR10_SUB_POLICIES), (num_images,), device=device)
+        for probs, operations, magnitudes in self.stages:
+            apply = torch.rand(num_images, device=device) < probs.to(device)[policy_idx]
+            operation = operations.to(device)[policy_idx]
+            magnitude = magnitudes.to(device)[policy_idx]
+            for i in operations.unique().tolist():
+                mask = (apply & (operation == i)).view(-1, 1, 1, 1)
+                images = torch.where(mask, BATCH_FUNC[self.operations[i]](images, magnitude, self.fillcolor), images)
+        return images
+
+    def __repr__(self):
+        return "Batched AutoAugment CIFAR10 Policy"
+
+
+def random_sign(magnitude):
+    return magnitude * (torch.randint(2, magnitude.shape, device=magnitude.device) * 2 - 1)
+
+
+def to_uint8(images):
+    return images.clamp(0, 255).to(torch.uint8)
+
+
+def grayscale(images):
+    # Fixed point ITU-R 601-2 luma transform, as used by PIL for convert("L")
+    r, g, b = images.int().unbind(dim=1)
+    return ((r * 19595 + g * 38470 + b * 7471 + 0x8000) >> 16).unsqueeze(1)
+
+
+def blend(degenerate, images, factor):
+    # Truncates like PIL's Image.blend
+    factor = factor.view(-1, 1, 1, 1)
+    return to_uint8(degenerate + factor * (images.float() - degenerate))
+
+
+def affine(images, matrix, fillcolor):
+    """
+    :param images: uint8 images of shape (N, C, H, W)
+    :param matrix: per image PIL AFFINE coefficients (a, b, c, d, e, f) of shape (N, 6), mapping output pixel
+        coordinates to input pixel coordinates
+    :param fillcolor: colour of the pixels mapped from outside the image
+    :return: images transformed with nearest neighbour sampling
+    """
+    num_images, num_channels, height, width = images.shape
+    ys, xs = torch.meshgrid(torch.arange(height, device=images.device) + 0.5,
+                            torch.arange(width, device=images.device) + 0.5, indexing='ij')
+    a, b, c, d, e, f = [coeff.view(-1, 1, 1) for coeff in matrix.unbind(dim=1)]
+    x_in = a * xs + b * ys + c
+    y_in = d * xs + e * ys + f
+    inside = ((x_in >= 0) & (x_in < width) & (y_in >= 0) & (y_in < height)).unsqueeze(1)
+    idx = y_in.floor().long().clamp(0, height - 1) * width + x_in.floor().long().clamp(0, width - 1)
+    out = images.reshape(num_images, num_channels, -1).gather(2, idx.view(num_images, 1, -1).expand(-1, num_channels, -1))
+    fill = torch.tensor(fillcolor, dtype=images.dtype, device=images.device).view(1, -1, 1, 1)
+    return torch.where(inside, out.view_as(images), fill)
+
+
+def shear(images, magnitude, fillcolor, dim):
+    # Shears along x with PIL's bicubic filter, which only interpolates along x as every row lands on pixel centres.
+    # Shearing along y is the same on the transposed images
+    if dim == 1:
+        images = images.transpose(2, 3)
+    num_images, num_channels, height, width = images.shape
+    ys, xs = torch.meshgrid(torch.arange(height, device=images.device) + 0.5,
+                            torch.arange(width, device=images.device) + 0.5, indexing='ij')
+    x_in = xs + random_sign(magnitude).view(-1, 1, 1) * ys
+    inside = ((x_in >= 0) & (x_in < width)).unsqueeze(1)
+    x_in = x_in - 0.5
+    x_0 = x_in.floor()
+    weights = cubic_weights(x_in - x_0)
+    x_0 = x_0.long() - 1
+    rows = torch.arange(height, device=images.device).view(1, -1, 1) * width
+    flat = images.reshape(num_images, num_channels, -1).float()
+    out = 0
+    for i in range(4):
+        idx = (rows + (x_0 + i).clamp(0, width - 1)).view(num_images, 1, -1).expand(-1, num_channels, -1)
+        out = out + weights[i].unsqueeze(1) * flat.gather(2, idx).view_as(images)
+    fill = torch.tensor(fillcolor, dtype=out.dtype, device=out.device).view(1, -1, 1, 1)
+    out = to_uint8(torch.where(inside, out, fill))
+    return out.transpose(2, 3) if dim == 1 else out
+
+
+def cubic_weights(t):
+    # Cubic convolution weights with a = -1, as in PIL's affine BICUBIC filter
+    t_2, t_3 = t * t, t * t * t
+    return [-t + 2 * t_2 - t_3, 1 - 2 * t_2 + t_3, t + t_2 - t_3, t_3 - t_2]
+
+
+def translate(images, magnitude, fillcolor, dim):
+    zeros, ones = torch.zeros_like(magnitude), torch.ones_like(magnitude)
+    magnitude = random_sign(magnitude) * images.shape[3 - dim]
+    if dim == 0:
+        matrix = [ones, zeros, magnitude, zeros, ones, zeros]
+    else:
+        matrix = [ones, zeros, zeros, zeros, ones, magnitude]
+    return affine(images, torch.stack(matrix, dim=1), fillcolor)
+
+
+def rotate(images, magnitude, fillcolor):
+    # Rotates counter-clockwise about the centre and fills with grey, as rotate_with_fill does
+    height, width = images.shape[2:]
+    angle = -torch.deg2rad(magnitude)
+    cos, sin = torch.cos(angle), torch.sin(angle)
+    centre_x, centre_y = width / 2, height / 2
+    matrix = [cos, sin, centre_x - cos * centre_x - sin * centre_y,
+              -sin, cos, centre_y + sin * centre_x - cos * centre_y]
+    return affine(images, torch.stack(matrix, dim=1), (128,) * images.shape[1])
+
+
+def color(images, magnitude, fillcolor):
+    return blend(grayscale(images).float(), images, 1 + random_sign(magnitude))
+
+
+def contrast(images, magnitude, fillcolor):
+    mean = (grayscale(images).float().mean(dim=(1, 2, 3), keepdim=True) + 0.5).floor()
+    return blend(mean, images, 1 + random_sign(magnitude))
+
+
+def sharpness(images, magnitude, fillcolor):
+    # PIL's SMOOTH filter, which leaves the border pixels untouched
+    num_channels = images.shape[1]
+    kernel = torch.ones(3, 3, device=images.device)
+    kernel[1, 1] = 5
+    kernel = (kernel / 13).expand(num_channels, 1, 3, 3)
+    smooth = F.conv2d(images.float(), kernel, groups=num_channels).round()
+    degenerate = images.float()
+    degenerate[:, :, 1:-1, 1:-1] = smooth
+    return blend(degenerate, images, 1 + random_sign(magnitude))
+
+
+def brightness(images, magnitude, fillcolor):
+    return blend(torch.zeros_like(images, dtype=torch.float), images, 1 + random_sign(magnitude))
+
+
+def posterize(images, magnitude, fillcolor):
+    shift = 8 - magnitude.int().view(-1, 1, 1, 1)
+    return ((images.int() >> shift) << shift).to(torch.uint8)
+
+
+def solarize(images, magnitude, fillcolor):
+    return torch.where(images.float() < magnitude.view(-1, 1, 1, 1), images, 255 - images)
+
+
+def autocontrast(images, magnitude, fillcolor):
+    low = images.amin(dim=(2, 3), keepdim=True).float()
+    high = images.amax(dim=(2, 3), keepdim=True).float()
+    scale = 255 / (high - low).clamp(min=1)
+    out = to_uint8((images.float() - low) * scale)
+    return torch.where(high > low, out, images)
+
+
+def equalize(images, magnitude, fillcolor):
+    # Per channel histogram equalization, with the same lookup table as ImageOps.equalize
+    num_images, num_channels, height, width = images.shape
+    flat = images.reshape(num_images * num_channels, -1).long()
+    hist = torch.zeros(flat.shape[0], 256, dtype=torch.long, device=images.device)
+    hist.scatter_add_(1, flat, torch.ones_like(flat))
+    last = hist.gather(1, flat.amax(dim=1, keepdim=True))
+    step = (height * width - last) // 255
+    lut = (step // 2 + hist.cumsum(dim=1) - hist) // step.clamp(min=1)
+    identity = torch.arange(256, device=images.device).expand_as(lut)
+    lut = torch.where(step > 0, lut.clamp(max=255), identity)
+    return lut.gather(1, flat).to(torch.uint8).view_as(images)
+
+
+def invert(images, magnitude, fillcolor):
+    return 255 - images
+
+
+BATCH_FUNC = {
+    "shearX": lambda images, magnitude, fillcolor: shear(images, magnitude, fillcolor, 0),
+    "shearY": lambda images, magnitude, fillcolor: shear(images, magnitude, fillcolor, 1),
+    "translateX": lambda images, magnitude, fillcolor: translate(images, magnitude, fillcolor, 0),
+    "translateY": lambda images, magnitude, fillcolor: translate(images, magnitude, fillcolor, 1),
+    "rotate": rotate,
+    "color": color,
+    "posterize": posterize,
+    "solarize": solarize,
+    "contrast": contrast,
+    "sharpness": sharpness,
+    "brightness": brightness,
+    "autocontrast": autocontrast,
+    "equalize": equalize,
+    "invert": invert
+}
@@ -0,0 +1,260 @@
+import torch
+import activation_functions as actfuns
+import util
+import argparse
+import csv
+import itertools
+import json
+import statistics
+import sys
+import time
+
+ACTFUNS_1D = ['relu', 'abs', 'swish', 'leaky_relu', 'tanh']
+BENCHMARK_KEYS = ['actfun', 'layer_type', 'p', 'k', 'permute_type', 'batch_size', 'channels', 'spatial', 'mode']
+FIELDNAMES = BENCHMARK_KEYS + ['latency_ms', 'samples_per_sec', 'peak_memory_mb']
+
+
+def get_all_actfuns():
+    """
+    :return: every activation function name accepted by activate
+    """
+    all_actfuns = list(actfuns._ACTFUNS) + ['cf_relu', 'cf_abs', 'groupsort']
+    return all_actfuns + actfuns._BIN_PARTITION_ACTFUNS + actfuns._BIN_ALL_ACTFUNS
+
+
+def get_benchmark_configs(args):
+    """
+    Expands the benchmark grid, dropping the combinations activate does not support. As in trainer.train, the
+    element-wise activation functions always use k = 1, and the others need k > 1
+    :param args: benchmark args
+    :return: list of config dicts, without duplicates
+    """
+    all_actfuns = get_all_actfuns() if args.actfuns == ['all'] else args.actfuns
+    configs = []
+    for actfun, layer_type, p, k, permute_type, batch_size, channels, spatial in itertools.product(
+            all_actfuns, args.layer_types, args.p, args.k, args.perm_methods, args.batch_sizes, args.channels,
+            args.spatial):
+        if actfun in ACTFUNS_1D:
+            k = 1
+        elif k == 1:
+            continue
+        if p == 1:
+            permute_type = args.perm_methods[0]
+        if layer_type == 'linear':
+            spatial = 1
+        if channels % k != 0 or (permute_type == 'invert' and p % k != 0):
+            continue
+        config = {'actfun': actfun, 'layer_type': layer_type, 'p': p, 'k': k, 'permute_type': permute_type,
+                  'batch_size': batch_size, 'channels': channels, 'spatial': spatial}
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def build_actfun_call(actfun, layer_type, p, k, permute_type, batch_size, channels, spatial, device):
+    """
+    Builds a call of activate for one layer. The permutation index and combinact alphas are made up front, as
+    HigherOrderActivation does, so only the per-batch work is timed
+    :return: (function of the pre-activations, random pre-activations)
+    """
+    if layer_type == 'conv':
+        x = torch.randn(batch_size, channels, spatial, spatial, device=device)
+    else:
+        x = torch.randn(batch_size, channels, device=device)
+    shuffle_maps = util.add_shuffle_map([], channels, p)[0].to(device)
+    perm_index = util.get_perm_index(shuffle_maps, p, k, permute_type) if p > 1 else None
+    alpha_primes = None
+    if actfun == 'combinact':
+        alpha_primes = torch.zeros(channels * p // k, len(actfuns.get_combinact_actfuns()), device=device,
+                                   requires_grad=True)
+
+    def call(z):
+        return actfuns.activate(z, actfun, p=p, k=k, M=channels,
+                                layer_type=layer_type,
+                                permute_type=permute_type,
+                                shuffle_maps=shuffle_maps,
+                                alpha_primes=alpha_primes,
+                                alpha_dist='per_cluster',
+                                perm_index=perm_index)
+
+    return call, x
+
+
+def synchronize(device):
+    if device.type == 'cuda':
+        torch.cuda.synchronize(device)
+
+
+def time_call(fn, device, repeats, warmup):
+    """
+    :return: median wall time of fn over repeats calls, in seconds
+    """
+    for _ in range(warmup):
+        fn()
+    times = []
+    for _ in range(repeats):
+        synchronize(device)
+        start_time = time.perf_counter()
+        fn()
+        synchronize(device)
+        times.append(time.perf_counter() - start_time)
+    return statistics.median(times)
+
+
+def get_call_memory(call, x, device, backward):
+    """
+    Memory used by a call beyond its input, in MiB. On GPU this is the allocator's peak. On CPU, where there is no
+    allocator to query, it is the size of the output plus the tensors saved for the backward pass, i.e. what the
+    call keeps alive until backprop during training
+    :param backward: whether the call records its graph for a backward pass
+    """
+    with torch.set_grad_enabled(backward):
+        z = x.clone()
+        if device.type == 'cuda':
+            synchronize(device)
+            torch.cuda.reset_peak_memory_stats(device)
+            base_memory = torch.cuda.memory_allocated(device)
+            output = call(z)
+            if backward:
+                output.backward(torch.ones_like(output))
+            synchronize(device)
+            return (torch.cuda.max_memory_allocated(device) - base_memory) / 2 ** 20
+
+        storages = {}
+
+        def pack(tensor):
+            storages[tensor.untyped_storage().data_ptr()] = tensor.untyped_storage().nbytes()
+            return tensor
+
+        with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+            output = call(z)
+        storages.pop(z.untyped_storage().data_ptr(), None)
+        storages[output.untyped_storage().data_ptr()] = output.untyped_storage().nbytes()
+        return sum(storages.values()) / 2 ** 20
+
+
+def benchmark_config(config, device, repeats, warmup):
+    """
+    Times the forward pass of activate, and the forward pass followed by its backward pass. The input is cloned in
+    every call, since the in-place activation functions cannot run on a leaf tensor and should not compound over
+    the repeats
+    :param config: config dict from get_benchmark_configs
+    :return: a forward and a backward result dict
+    """
+    call, x = build_actfun_call(device=device, **config)
+    results = []
+    for mode in ['forward', 'backward']:
+        if mode == 'forward':
+            def fn():
+                with torch.no_grad():
+                    call(x.clone())
+        else:
+            x.requires_grad_()
+            with torch.no_grad():
+                grad_output = torch.randn_like(call(x.clone()))
+
+            def fn():
+                call(x.clone()).backward(grad_output)
+        latency = time_call(fn, device, repeats, warmup)
+        result = dict(config)
+        result.update({'mode': mode,
+                       'latency_ms': latency * 1000,
+                       'samples_per_sec': config['batch_size'] / latency,
+                       'peak_memory_mb': get_call_memory(call, x, device, mode == 'backward')})
+        results.append(result)
+    return results
+
+
+def write_results(results, path, fieldnames=FIELDNAMES):
+    """
+    Writes results as JSON if path ends in .json, otherwise as CSV
+    """
+    with open(path, 'w') as out_file:
+        if path.endswith('.json'):
+            json.dump(results, out_file, indent=1)
+        else:
+            writer = csv.DictWriter(out_file, fieldnames=fieldnames, lineterminator='\n')
+            writer.writeheader()
+            writer.writerows(results)
+
+
+def read_results(path):
+    with open(path) as in_file:
+        if path.endswith('.json'):
+            return json.load(in_file)
+        return list(csv.DictReader(in_file))
+
+
+def compare_results(results, baseline, tolerance, keys=BENCHMARK_KEYS):
+    """
+    Prints the latency of every benchmark relative to the same benchmark in the baseline
+    :param results: results of this run
+    :param baseline: results of a previous run, from read_results
+    :param tolerance: relative slowdown above which a benchmark counts as a regression
+    :param keys: fields identifying a benchmark
+    :return: list of (result, baseline latency) for the regressed benchmarks
+    """
+    def get_key(result):
+        return tuple(str(result[key]) for key in keys)
+
+    baseline = {get_key(result): float(result['latency_ms']) for result in baseline}
+    regressions = []
+    for result in results:
+        if get_key(result) not in baseline:
+            continue
+        baseline_latency = baseline[get_key(result)]
+        ratio = result['latency_ms'] / baseline_latency
+        print("{:60s} {:9.3f} ms -> {:9.3f} ms ({:.2f}x){}".format(
+            ' '.join(str(result[key]) for key in keys), baseline_latency, result['latency_ms'], ratio,
+            ' REGRESSION' if ratio > 1 + tolerance else ''))
+        if ratio > 1 + tolerance:
+            regressions.append((result, baseline_latency))
+    return regressions
+
+
+# --------------------  Entry Point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Activation function microbenchmarks')
+    parser.add_argument('--actfuns', type=str, nargs='+', default=['all'], help='Activation functions, or all')
+    parser.add_argument('--layer_types', type=str, nargs='+', default=['conv', 'linear'], help='conv, linear')
+    parser.add_argument('--p', type=int, nargs='+', default=[1, 2], help='p values')
+    parser.add_argument('--k', type=int, nargs='+', default=[2, 4], help='k values')
+    parser.add_argument('--perm_methods', type=str, nargs='+', default=['shuffle'],
+                        help='shuffle, roll, roll_grouped, invert')
+    parser.add_argument('--batch_sizes', type=int, nargs='+', default=[128], help='Batch sizes')
+    parser.add_argument('--channels', type=int, nargs='+', default=[64], help='Pre-activation channels or nodes M')
+    parser.add_argument('--spatial', type=int, nargs='+', default=[16], help='Image side length of conv layers')
+    parser.add_argument('--repeats', type=int, default=20, help='Timed calls per benchmark')
+    parser.add_argument('--warmup', type=int, default=3, help='Untimed calls before each benchmark')
+    parser.add_argument('--device', type=str, default='cpu', help='Device to benchmark on')
+    parser.add_argument('--num_threads', type=int, default=None, help='Torch CPU threads, defaults to all')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the inputs and permutations')
+    parser.add_argument('--save_path', type=str, default='', help='Where to save results, .json or .csv')
+    parser.add_argument('--baseline', type=str, default='', help='Saved results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative slowdown over the baseline reported as a regression')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device)
+
+    results = []
+    for config in get_benchmark_configs(args):
+        util.seed_all(args.seed)
+        forward_result, backward_result = benchmark_config(config, device, args.repeats, args.warmup)
+        results += [forward_result, backward_result]
+        if not args.baseline:
+            print("{:60s} fwd {:9.3f} ms | fwd+bwd {:9.3f} ms | {:10.0f} samples/s | {:8.2f} MiB".format(
+                ' '.join(str(config[key]) for key in BENCHMARK_KEYS[:-1]), forward_result['latency_ms'],
+                backward_result['latency_ms'], backward_result['samples_per_sec'],
+                backward_result['peak_memory_mb']))
+
+    if args.save_path:
+        write_results(results, args.save_path)
+    if args.baseline:
+        regressions = compare_results(results, read_results(args.baseline), args.tolerance)
+        print("{} of {} benchmarks regressed by more than {:.0%}".format(len(regressions), len(results),
+                                                                         args.tolerance))
+        if regressions:
+            sys.exit(1)
@@ -0,0 +1,147 @@
+import torch
+import torch.nn as nn
+import torch.optim as optim
+import benchmark_actfuns
+import trainer
+import util
+import argparse
+import itertools
+import sys
+
+BENCHMARK_KEYS = ['model', 'dataset', 'actfun', 'p', 'k', 'g', 'perm_method', 'num_params', 'resnet_width',
+                  'batch_size', 'mode']
+FIELDNAMES = BENCHMARK_KEYS + ['model_params', 'latency_ms', 'samples_per_sec', 'epoch_sec', 'peak_memory_mb']
+INPUT_SHAPES = {
+    'mnist': ((1, 28, 28), 10),
+    'fashion_mnist': ((1, 28, 28), 10),
+    'cifar10': ((3, 32, 32), 10),
+    'svhn': ((3, 32, 32), 10),
+    'cifar100': ((3, 32, 32), 100),
+}
+
+
+def get_benchmark_configs(args):
+    """
+    Expands the benchmark grid. As in trainer.train, the element-wise activation functions always use k = 1.
+    num_params only sizes the MLP and CNN, and resnet_width only the ResNet, so each is 0 where it does not apply
+    :param args: benchmark args
+    :return: list of config dicts, without duplicates
+    """
+    configs = []
+    for model, actfun, p, k, g, num_params, resnet_width in itertools.product(
+            args.models, args.actfuns, args.p, args.k, args.g, args.num_params, args.resnet_widths):
+        if actfun in benchmark_actfuns.ACTFUNS_1D:
+            k = 1
+        if model == 'resnet':
+            num_params = 0
+        else:
+            resnet_width = 0
+        config = {'model': model, 'dataset': args.dataset, 'actfun': actfun, 'p': p, 'k': k, 'g': g,
+                  'perm_method': args.perm_method, 'num_params': num_params, 'resnet_width': resnet_width,
+                  'batch_size': args.batch_size}
+        if config not in configs:
+            configs.append(config)
+    return configs
+
+
+def benchmark_config(config, args, device):
+    """
+    Times train steps and inference of a model built by trainer.load_model, on a fixed batch of random images
+    that is already on the device, so that only the model code is measured
+    :param config: config dict from get_benchmark_configs
+    :param args: benchmark args
+    :param device: device to benchmark on
+    :return: a train and an inference result dict
+    """
+    model, model_params = trainer.load_model(config['model'], config['dataset'], config['actfun'], config['k'],
+                                             config['p'], config['g'], num_params=config['num_params'],
+                                             perm_method=config['perm_method'], device=device,
+                                             resnet_ver=args.resnet_ver, resnet_width=config['resnet_width'],
+                                             verbose=False)
+    model.apply(util.weights_init)
+    forward_model = torch.compile(model) if args.compile else model
+    optimizer = optim.Adam(model_params)
+    criterion = nn.CrossEntropyLoss()
+
+    input_shape, num_outputs = INPUT_SHAPES[config['dataset']]
+    x = torch.randn(config['batch_size'], *input_shape, device=device)
+    target = torch.randint(num_outputs, (config['batch_size'],), device=device)
+
+    def train_step():
+        optimizer.zero_grad()
+        criterion(forward_model(x), target).backward()
+        optimizer.step()
+
+    def inference_step():
+        with torch.no_grad():
+            forward_model(x)
+
+    results = []
+    for mode, step, train_mode in [('train', train_step, True), ('inference', inference_step, False)]:
+        model.train(train_mode)
+        if device.type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(device)
+        latency = benchmark_actfuns.time_call(step, device, args.steps, args.warmup)
+        result = dict(config)
+        result.update({'mode': mode,
+                       'model_params': util.get_model_params(model),
+                       'latency_ms': latency * 1000,
+                       'samples_per_sec': config['batch_size'] / latency,
+                       'epoch_sec': args.epoch_size * latency / config['batch_size'],
+                       'peak_memory_mb': torch.cuda.max_memory_allocated(device) / 2 ** 20
+                       if device.type == 'cuda' else None})
+        results.append(result)
+    return results
+
+
+# --------------------  Entry Point
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Model throughput benchmarks on synthetic data')
+    parser.add_argument('--models', type=str, nargs='+', default=['mlp', 'cnn', 'resnet'], help='mlp, cnn, resnet')
+    parser.add_argument('--dataset', type=str, default='cifar10', help='Data set whose input shape is used')
+    parser.add_argument('--actfuns', type=str, nargs='+', default=['max', 'relu'], help='Activation functions')
+    parser.add_argument('--p', type=int, nargs='+', default=[1], help='p values')
+    parser.add_argument('--k', type=int, nargs='+', default=[2], help='k values')
+    parser.add_argument('--g', type=int, nargs='+', default=[1], help='g values')
+    parser.add_argument('--perm_method', type=str, default='shuffle', help='Which permuation method to use')
+    parser.add_argument('--num_params', type=int, nargs='+', default=[1000000],
+                        help='Parameter budgets of the MLP and CNN')
+    parser.add_argument('--resnet_ver', type=int, default=18, help='Which version of ResNet to use')
+    parser.add_argument('--resnet_widths', type=float, nargs='+', default=[1.0, 2.0], help='ResNet layer widths')
+    parser.add_argument('--batch_size', type=int, default=128, help='Batch size')
+    parser.add_argument('--steps', type=int, default=10, help='Timed steps per benchmark')
+    parser.add_argument('--warmup', type=int, default=2, help='Untimed steps before each benchmark')
+    parser.add_argument('--epoch_size', type=int, default=50000, help='Samples per epoch used for epoch_sec')
+    parser.add_argument('--compile', action='store_true', help='When true, benchmarks torch.compile-d models')
+    parser.add_argument('--device', type=str, default=None, help='Device to benchmark on, defaults to cuda if found')
+    parser.add_argument('--num_threads', type=int, default=None, help='Torch CPU threads, defaults to all')
+    parser.add_argument('--seed', type=int, default=0, help='Seed for the models and inputs')
+    parser.add_argument('--save_path', type=str, default='', help='Where to save results, .json or .csv')
+    parser.add_argument('--baseline', type=str, default='', help='Saved results to compare against')
+    parser.add_argument('--tolerance', type=float, default=0.1,
+                        help='Relative slowdown over the baseline reported as a regression')
+    args = parser.parse_args()
+
+    if args.num_threads is not None:
+        torch.set_num_threads(args.num_threads)
+    device = torch.device(args.device or ('cuda' if torch.cuda.is_available() else 'cpu'))
+
+    results = []
+    for config in get_benchmark_configs(args):
+        util.seed_all(args.seed)
+        train_result, inference_result = benchmark_config(config, args, device)
+        results += [train_result, inference_result]
+        if not args.baseline:
+            print("{:60s} {:9d} params | train {:9.1f} img/s | inference {:9.1f} img/s | {:8.1f} s/epoch".format(
+                ' '.join(str(config[key]) for key in BENCHMARK_KEYS[:-1]), train_result['model_params'],
+                train_result['samples_per_sec'], inference_result['samples_per_sec'], train_result['epoch_sec']))
+
+    if args.save_path:
+        benchmark_actfuns.write_results(results, args.save_path, FIELDNAMES)
+    if args.baseline:
+        regressions = benchmark_actfuns.compare_results(results, benchmark_actfuns.read_results(args.baseline),
+                                                        args.tolerance, BENCHMARK_KEYS)
+        print("{} of {} benchmarks regressed by more than {:.0%}".format(len(regressions), len(results),
+                                                                         args.tolerance))
+        if regressions:
+            sys.exit(1)
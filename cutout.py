@@ -41,4 +41,42 @@ class Cutout(object):
         mask = mask.expand_as(img)
         img = img * mask
 
-        return img
\ No newline at end of file
+        return img
+
+
+class BatchCutout(object):
+    """Randomly mask out one or more patches from each image of a batch, on the device holding the batch.
+
+    Args:
+        n_holes (int): Number of patches to cut out of each image.
+        length (int): The length (in pixels) of each square patch.
+    """
+
+    def __init__(self, n_holes, length):
+        self.n_holes = n_holes
+        self.length = length
+
+    def __call__(self, imgs):
+        """
+        Args:
+            imgs (Tensor): Tensor images of size (B, C, H, W), or a single image of size (C, H, W).
+        Returns:
+            Tensor: Images with n_holes of dimension length x length cut out of each, placed as Cutout does.
+        """
+        if imgs.dim() == 3:
+            return self(imgs.unsqueeze(0)).squeeze(0)
+        if imgs.dim() != 4:
+            raise ValueError('BatchCutout expects images of size (B, C, H, W) or (C, H, W), got {}'.format(
+                tuple(imgs.shape)))
+        b, _, h, w = imgs.shape
+
+        y = torch.randint(h, (b, self.n_holes, 1), device=imgs.device)
+        x = torch.randint(w, (b, self.n_holes, 1), device=imgs.device)
+        rows = torch.arange(h, device=imgs.device)
+        cols = torch.arange(w, device=imgs.device)
+
+        in_y = (rows >= y - self.length // 2) & (rows < y + self.length // 2)
+        in_x = (cols >= x - self.length // 2) & (cols < x + self.length // 2)
+        holes = (in_y.unsqueeze(3) & in_x.unsqueeze(2)).any(dim=1)
+
+        return imgs.masked_fill(holes.unsqueeze(1), 0.)
@@ -5,14 +5,13 @@ import argparse
 import os
 import datetime
 import csv
+import json
+import multiprocessing
+import concurrent.futures
 import trainer
 
-
-def retrieve_checkpoint(curr_entry, full_arr):
-    if curr_entry in full_arr:
-        return full_arr[full_arr.index(curr_entry):]
-    else:
-        return full_arr
+# Loaders reused by the jobs this process runs
+dataset_cache = util.DatasetCache()
 
 
 def setup_experiment(args):
@@ -37,34 +36,72 @@ def setup_experiment(args):
                       'gen_gap', 'aug_gen_gap', 'resnet_ver', 'resnet_width', 'epoch_train_loss',
                       'epoch_train_acc', 'epoch_aug_train_loss', 'epoch_aug_train_acc', 'epoch_val_loss',
                       'epoch_val_acc', 'epoch_aug_val_loss', 'epoch_aug_val_acc', 'hp_idx', 'curr_lr',
-                      'found_lr', 'hparams', 'epochs']
+                      'found_lr', 'hparams', 'epochs', 'data_time', 'h2d_time', 'forward_time', 'backward_time',
+                      'step_time', 'eval_time', 'checkpoint_time', 'samples_per_sec', 'peak_memory_mb']
 
     if args.model == 'resnet':
         model = "{}-{}-{}".format(args.model, args.resnet_ver, args.resnet_width)
     else:
         model = args.model
-    filename = '{}-{}-{}-{}-{}{}'.format(datetime.date.today(),
-                                         args.seed,
-                                         args.dataset,
-                                         model,
-                                         args.actfun,
-                                         args.label)
+    sweep_name = '{}-{}-{}-{}{}'.format(args.seed,
+                                        args.dataset,
+                                        model,
+                                        args.actfun,
+                                        args.label)
+    filename = '{}-{}'.format(datetime.date.today(), sweep_name)
 
     outfile_path = os.path.join(args.save_path, filename) + '.csv'
-    mid_checkpoint_path = os.path.join(args.check_path, filename) + '.pth'
-    checkpoint = None
 
     if not os.path.exists(outfile_path):
         with open(outfile_path, mode='w') as out_file:
             writer = csv.DictWriter(out_file, fieldnames=fieldnames, lineterminator='\n')
             writer.writeheader()
 
-    all_actfuns = util.get_actfuns(args.actfun)
-    if os.path.exists(mid_checkpoint_path):
-        checkpoint = torch.load(mid_checkpoint_path)
-        all_actfuns = retrieve_checkpoint(checkpoint['actfun'], all_actfuns)
+    # The ledger of finished jobs and the per-job checkpoints are not dated, so a sweep can resume on a later day
+    ledger_path = None
+    jobs = get_sweep_jobs(args, util.get_actfuns(args.actfun))
+    if args.check_path != '':
+        ledger_path = os.path.join(args.check_path, sweep_name) + '_jobs.jsonl'
+        finished_jobs = load_finished_jobs(ledger_path)
+        jobs = [job for job in jobs if get_job_key(job) not in finished_jobs]
+    job_checkpoint_prefix = os.path.join(args.check_path, sweep_name)
+    dataset_cache.size_for_sweep(args, jobs)
+
+    if args.autotune_loader > 0 and len(jobs) > 0:
+        args.loader_workers = util.autotune_loader_workers(args, device, jobs[0]['curr_seed'], jobs[0]['sample_size'],
+                                                           args.autotune_loader)
 
     # =========================== Training
+    if args.workers > 1:
+        mp_context = multiprocessing.get_context('spawn')
+        with concurrent.futures.ProcessPoolExecutor(max_workers=args.workers, mp_context=mp_context,
+                                                    initializer=init_sweep_worker,
+                                                    initargs=(args.workers,)) as executor:
+            futures = {}
+            for job_idx, job in enumerate(jobs):
+                job_device = device
+                if use_cuda:
+                    job_device = torch.device('cuda', job_idx % torch.cuda.device_count())
+                future = executor.submit(run_job, args, job, model, outfile_path,
+                                         get_job_checkpoint_path(job_checkpoint_prefix, job), fieldnames, job_device)
+                futures[future] = job
+            finish_jobs(futures, ledger_path, job_checkpoint_prefix)
+    else:
+        for job in jobs:
+            job_checkpoint_path = get_job_checkpoint_path(job_checkpoint_prefix, job)
+            run_job(args, job, model, outfile_path, job_checkpoint_path, fieldnames, device)
+            finish_job(ledger_path, job, job_checkpoint_path)
+
+
+def get_sweep_jobs(args, all_actfuns):
+    """
+    Enumerates the experiment grid into the list of training jobs, in the order they would be trained sequentially
+    :param args: args passed in for current experiment
+    :param all_actfuns: activation functions to sweep over
+    :return: list of jobs, each a dict of the arguments for one training session
+    """
+
+    jobs = []
     for actfun in all_actfuns:
 
         num_params = util.get_num_params(args)
@@ -73,14 +110,6 @@ def setup_experiment(args):
         perm_methods = util.get_perm_methods(args)
         curr_seed = (args.seed * len(num_params) * len(train_samples) * len(p_vals) * len(k_vals) * len(
             g_vals) * len(perm_methods))
-        if checkpoint is not None:
-            num_params = retrieve_checkpoint(checkpoint['num_params'], num_params)
-            if train_samples[0] is not None:
-                train_samples = retrieve_checkpoint(checkpoint['sample_size'], train_samples)
-            p_vals = retrieve_checkpoint(checkpoint['p'], p_vals)
-            k_vals = retrieve_checkpoint(checkpoint['k'], k_vals)
-            perm_methods = retrieve_checkpoint(checkpoint['perm_method'], perm_methods)
-            curr_seed = checkpoint['curr_seed']
 
         for curr_num_params in num_params:
             for curr_sample_size in train_samples:
@@ -92,40 +121,137 @@ def setup_experiment(args):
                                 g = p
 
                             for perm_method in perm_methods:
+                                jobs.append({'actfun': actfun,
+                                             'curr_seed': curr_seed,
+                                             'sample_size': curr_sample_size,
+                                             'num_params': curr_num_params,
+                                             'p': p, 'k': k, 'g': g,
+                                             'perm_method': perm_method})
 
-                                filename = '{}-{}-{}-{}-{}-{}-{}-{}{}'.format(args.seed,
-                                                                              args.dataset,
-                                                                              model,
-                                                                              actfun,
-                                                                              p, k, g, perm_method,
-                                                                              args.label
-                                                                              )
-                                final_checkpoint_path = os.path.join(args.save_path, filename) + '_final.pth'
-                                best_checkpoint_path = os.path.join(args.save_path, filename) + '_best.pth'
-
-                                # ---- Begin training model
-                                trainer.train(args,
-                                              checkpoint,
-                                              mid_checkpoint_path,
-                                              final_checkpoint_path,
-                                              best_checkpoint_path,
-                                              actfun,
-                                              curr_seed,
-                                              outfile_path,
-                                              filename,
-                                              fieldnames,
-                                              curr_sample_size,
-                                              device,
-                                              num_params=curr_num_params,
-                                              curr_p=p,
-                                              curr_k=k,
-                                              curr_g=g,
-                                              perm_method=perm_method)
-                                print()
-
-                                checkpoint = None
                                 curr_seed += 1
 
+    return jobs
+
+
+def get_job_key(job):
+    return (job['actfun'], job['num_params'], job['sample_size'], job['p'], job['k'], job['g'],
+            job['perm_method'], job['curr_seed'])
+
+
+def get_job_checkpoint_path(prefix, job):
+    return '{}-{}.pth'.format(prefix, '-'.join(str(value) for value in get_job_key(job)))
+
+
+def load_finished_jobs(ledger_path):
+    """
+    :param ledger_path: path of the JSON-lines ledger of finished jobs
+    :return: set of the keys of all jobs recorded as finished
+    """
+    finished_jobs = set()
+    if os.path.exists(ledger_path):
+        with open(ledger_path) as ledger:
+            for line in ledger:
+                if line.strip():
+                    finished_jobs.add(tuple(json.loads(line)['job']))
+    return finished_jobs
+
+
+def finish_job(ledger_path, job, job_checkpoint_path):
+    """
+    Records a job as finished in the ledger, after which its mid-training checkpoint is no longer needed
+    :param ledger_path: path of the JSON-lines ledger of finished jobs, or None when not checkpointing
+    :param job: dict of the arguments for the finished training session
+    :param job_checkpoint_path: path of the job's mid-training checkpoint
+    :return:
+    """
+    if ledger_path is None:
+        return
+    with open(ledger_path, mode='a') as ledger:
+        ledger.write(json.dumps({'job': get_job_key(job)}) + '\n')
+    if os.path.exists(job_checkpoint_path):
+        os.remove(job_checkpoint_path)
+
+
+def finish_jobs(futures, ledger_path, job_checkpoint_prefix):
+    """
+    Records every job as finished in the ledger as soon as it succeeds. A failing job does not stop the others from
+    being recorded, since they still write their results, so its exception is only raised once all jobs are done
+    :param futures: dict mapping the future of each submitted job to the job
+    :param ledger_path: path of the JSON-lines ledger of finished jobs, or None when not checkpointing
+    :param job_checkpoint_prefix: path prefix of the per-job checkpoints
+    :return:
+    """
+    first_exception = None
+    for future in concurrent.futures.as_completed(futures):
+        job = futures[future]
+        exception = future.exception()
+        if exception is not None:
+            print("Job {} failed: {!r}".format(get_job_key(job), exception))
+            if first_exception is None:
+                first_exception = exception
+            continue
+        finish_job(ledger_path, job, get_job_checkpoint_path(job_checkpoint_prefix, job))
+    if first_exception is not None:
+        raise first_exception
+
+
+def init_sweep_worker(num_workers):
+    # Share the CPU cores between the concurrently training jobs
+    torch.set_num_threads(max(1, os.cpu_count() // num_workers))
+
+
+def run_job(args, job, model, outfile_path, mid_checkpoint_path, fieldnames, device):
+    """
+    Trains a single job of the experiment grid, resuming from its mid-training checkpoint if one exists
+    :param args: args passed in for current experiment
+    :param job: dict of the arguments for this training session, from get_sweep_jobs
+    :param model: model name used in output file names
+    :param outfile_path: path to save outputs from experiment
+    :param mid_checkpoint_path: path of the checkpoint saved during training
+    :param fieldnames: column names for output file
+    :param device: device to train on
+    :return:
+    """
+
+    if device.type == 'cuda' and device.index is not None:
+        torch.cuda.set_device(device)
+
+    checkpoint = None
+    if args.check_path != '' and os.path.exists(mid_checkpoint_path):
+        # Checkpoints are written by trainer.train and hold numpy hyper-parameters in the optimizer state
+        checkpoint = torch.load(mid_checkpoint_path, map_location=device, weights_only=False)
+
+    filename = '{}-{}-{}-{}-{}-{}-{}-{}{}'.format(args.seed,
+                                                  args.dataset,
+                                                  model,
+                                                  job['actfun'],
+                                                  job['p'], job['k'], job['g'], job['perm_method'],
+                                                  args.label
+                                                  )
+    final_checkpoint_path = os.path.join(args.save_path, filename) + '_final.pth'
+    best_checkpoint_path = os.path.join(args.save_path, filename) + '_best.pth'
+
+    # ---- Begin training model
+    trainer.train(args,
+                  checkpoint,
+                  mid_checkpoint_path,
+                  final_checkpoint_path,
+                  best_checkpoint_path,
+                  job['actfun'],
+                  job['curr_seed'],
+                  outfile_path,
+                  filename,
+                  fieldnames,
+                  job['sample_size'],
+                  device,
+                  num_params=job['num_params'],
+                  curr_p=job['p'],
+                  curr_k=job['k'],
+                  curr_g=job['g'],
+                  perm_method=job['perm_method'],
+                  dataset_cache=dataset_cache)
+    print()
+
 
 # --------------------  Entry Point
 if __name__ == '__main__':
@@ -158,10 +284,39 @@ if __name__ == '__main__':
     parser.add_argument('--momentum', type=float, default=0, help='Maximum LR during one cycle schedule')
     parser.add_argument('--checkpoints', action='store_true', help='When true, stores permanent checkpoints')
     parser.add_argument('--aug', action='store_true', help='When true, uses training set augmentations')
+    parser.add_argument('--aug_eval_every', type=int, default=1,
+                        help='Evaluates the augmented eval set every N epochs and on the last epoch, 0 to never')
+    parser.add_argument('--preload', action='store_true',
+                        help='When true, holds the un-augmented data on the training device and batches it there')
+    parser.add_argument('--batch_aug', action='store_true',
+                        help='When true, applies the CIFAR augmentations to whole batches on the training device')
+    parser.add_argument('--loader_workers', type=int, default=None,
+                        help='Worker processes per data loader, defaults to 1 on GPU and 0 on CPU')
+    parser.add_argument('--prefetch_factor', type=int, default=2, help='Batches loaded in advance by each worker')
+    parser.add_argument('--persistent_workers', action='store_true',
+                        help='When true, keeps the loader workers alive between epochs')
+    parser.add_argument('--no_pin_memory', action='store_true', help='When true, does not pin batches on GPU')
+    parser.add_argument('--autotune_loader', type=int, default=0,
+                        help='Times N batches for each number of loader workers and uses the fastest, 0 to disable')
+    parser.add_argument('--profile', action='store_true',
+                        help='When true, synchronizes the GPU between training phases so their times are exact')
+    parser.add_argument('--data_store', type=str, default='',
+                        help='Directory of memory-mapped .npy copies of the data sets, converted on first use')
+    parser.add_argument('--aug_cache', type=str, default='',
+                        help='Directory of memory-mapped augmented images, replayed by later runs with the same seed')
+    parser.add_argument('--cutout_holes', type=int, default=0,
+                        help='Number of Cutout patches masked from each training batch image, 0 to disable')
+    parser.add_argument('--cutout_length', type=int, default=16, help='Side length of the Cutout patches')
 
     parser.add_argument('--var_n_params', type=str, default='', help='varies number of network parameters')
     parser.add_argument('--var_n_samples', action='store_true', help='When true, varies number of training samples')
     parser.add_argument('--reduce_actfuns', action='store_true', help='When true, does not use extra actfuns')
+    parser.add_argument('--combinact_recompute', action='store_true',
+                        help='When true, combinact recomputes its actfuns during backprop instead of storing them. '
+                             'Ignored with --compile, which traces the plain combinact')
+    parser.add_argument('--compile', action='store_true', help='When true, trains with a torch.compile-d model')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='Number of sweep jobs trained concurrently, spread over the available GPUs')
     parser.add_argument('--var_p', action='store_true', help='When true, varies p hyper-param')
     parser.add_argument('--var_k', action='store_true', help='When true, varies k hyper-param')
     parser.add_argument('--var_g', action='store_true', help='When true, varies g hyper-param')
@@ -186,5 +341,7 @@ if __name__ == '__main__':
 
 
     args = parser.parse_args()
+    if args.compile and args.combinact_recompute:
+        print("Warning: --combinact_recompute is ignored with --compile, which traces the plain combinact")
 
     setup_experiment(args)
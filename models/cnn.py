@@ -17,7 +17,8 @@ class CNN(nn.Module):
                  alpha_dist="per_cluster",
                  permute_type="shuffle",
                  reduce_actfuns=False,
-                 num_params=3000000):
+                 num_params=3000000,
+                 combinact_recompute=False):
         super(CNN, self).__init__()
 
         if permute_type == 'invert' and p % k != 0:
@@ -27,7 +28,6 @@ class CNN(nn.Module):
         self.p, self.k, self.g = p, k, g
         self.permute_type = permute_type
         self.alpha_dist = alpha_dist
-        self.shuffle_maps = []
         self.reduce_actfuns = reduce_actfuns
 
         pk_ratio = util.get_pk_ratio(self.actfun, self.p, self.k, self.g)
@@ -60,12 +60,18 @@ class CNN(nn.Module):
                                      kernel_size=3, padding=1, groups=self.g)])
         ])
 
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[0]), self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[1]), self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[2]), self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[2]), self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[3]), self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[3]), self.p)
+        # l2_lae uses l2 on the conv layers and lae on the linear layers. Forward used to overwrite self.actfun with
+        # 'lae', so every pass after the first also used lae on the conv layers; the split now holds for every pass
+        conv_actfun = 'l2' if self.actfun == 'l2_lae' else self.actfun
+        linear_actfun = 'lae' if self.actfun == 'l2_lae' else self.actfun
+        self.activations = nn.ModuleList()
+        for pre_act in [pre_acts[0], pre_acts[1], pre_acts[2], pre_acts[2], pre_acts[3], pre_acts[3]]:
+            self.activations.append(actfuns.HigherOrderActivation(conv_actfun, int(pre_act), p=self.p, k=self.k,
+                                                                  layer_type='conv',
+                                                                  permute_type=self.permute_type,
+                                                                  alpha_dist=self.alpha_dist,
+                                                                  reduce_actfuns=self.reduce_actfuns,
+                                                                  combinact_recompute=combinact_recompute))
 
         self.batch_norms = nn.ModuleList([
             nn.ModuleList([nn.BatchNorm2d(int(pre_acts[0])),
@@ -83,17 +89,18 @@ class CNN(nn.Module):
         ])
 
         self.linear_layers = nn.ModuleDict()
-        self.linear_layers['l1'] = nn.ModuleList()
-        self.linear_layers['l2'] = nn.ModuleList()
-
-        for group in range(g):
-            self.linear_layers['l1'].append(nn.Linear(int(post_acts[3] * (int(input_dim / 8) ** 2) / self.g),
-                                                      int(pre_acts[5] / self.g)))
-            self.linear_layers['l2'].append(nn.Linear(int(post_acts[5] / self.g), int(pre_acts[4] / self.g)))
+        self.linear_layers['l1'] = util.GroupedLinear(int(post_acts[3] * (int(input_dim / 8) ** 2) / self.g),
+                                                      int(pre_acts[5] / self.g), self.g)
+        self.linear_layers['l2'] = util.GroupedLinear(int(post_acts[5] / self.g), int(pre_acts[4] / self.g), self.g)
         self.linear_layers['l3'] = nn.Linear(int(post_acts[4]), int(num_outputs))
 
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[5]), self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, int(pre_acts[4]), self.p)
+        for pre_act in [pre_acts[5], pre_acts[4]]:
+            self.activations.append(actfuns.HigherOrderActivation(linear_actfun, int(pre_act), p=self.p, k=self.k,
+                                                                  layer_type='linear',
+                                                                  permute_type=self.permute_type,
+                                                                  alpha_dist=self.alpha_dist,
+                                                                  reduce_actfuns=self.reduce_actfuns,
+                                                                  combinact_recompute=combinact_recompute))
 
         self.all_alpha_primes = nn.ParameterList()  # List of our trainable alpha prime values
         self.alpha_dist = alpha_dist  # Reference to chosen alpha distribution
@@ -116,89 +123,28 @@ class CNN(nn.Module):
     def forward(self, x):
 
         # ------------- Conv layers
-        if self.actfun == 'l2_lae':
-            actfun = 'l2'
-        else:
-            actfun = self.actfun
-
         for block in range(3):
             x = self.conv_layers[block][0](x)
             x = self.batch_norms[block][0](x)
-            if actfun == 'combinact':
-                alpha_primes = self.all_alpha_primes[block * 2]
-            else:
-                alpha_primes = None
-            x = actfuns.activate(x, actfun=actfun,
-                                 k=self.k, p=self.p, M=x.shape[1],
-                                 layer_type='conv',
-                                 permute_type=self.permute_type,
-                                 shuffle_maps=self.shuffle_maps[block * 2],
-                                 alpha_primes=alpha_primes,
-                                 alpha_dist=self.alpha_dist,
-                                 reduce_actfuns=self.reduce_actfuns)
+            x = self.activate(x, block * 2)
             x = self.conv_layers[block][1](x)
             x = self.batch_norms[block][1](x)
-            if actfun == 'combinact':
-                alpha_primes = self.all_alpha_primes[(block * 2) + 1]
-            else:
-                alpha_primes = None
-            x = actfuns.activate(x, actfun=actfun,
-                                 k=self.k, p=self.p, M=x.shape[1],
-                                 layer_type='conv',
-                                 permute_type=self.permute_type,
-                                 shuffle_maps=self.shuffle_maps[(block * 2) + 1],
-                                 alpha_primes=alpha_primes,
-                                 alpha_dist=self.alpha_dist,
-                                 reduce_actfuns=self.reduce_actfuns)
+            x = self.activate(x, (block * 2) + 1)
             x = self.pooling[block](x)
 
         x = x.reshape(x.size(0), -1)
 
         # ------------- Linear layers
-        if self.actfun == 'l2_lae':
-            self.actfun = 'lae'
-
-        x = self.grouped_fc(x, self.linear_layers['l1'])
-        if self.actfun == 'combinact':
-            alpha_primes = self.all_alpha_primes[6]
-        else:
-            alpha_primes = None
-        x = actfuns.activate(x, actfun=self.actfun,
-                             k=self.k, p=self.p, M=x.shape[1],
-                             layer_type='linear',
-                             permute_type=self.permute_type,
-                             shuffle_maps=self.shuffle_maps[6],
-                             alpha_primes=alpha_primes,
-                             alpha_dist=self.alpha_dist,
-                             reduce_actfuns=self.reduce_actfuns)
-
-        x = self.grouped_fc(x, self.linear_layers['l2'])
-        if self.actfun == 'combinact':
-            alpha_primes = self.all_alpha_primes[7]
-        else:
-            alpha_primes = None
-        x = actfuns.activate(x, actfun=self.actfun,
-                             k=self.k, p=self.p, M=x.shape[1],
-                             layer_type='linear',
-                             permute_type=self.permute_type,
-                             shuffle_maps=self.shuffle_maps[7],
-                             alpha_primes=alpha_primes,
-                             alpha_dist=self.alpha_dist,
-                             reduce_actfuns=self.reduce_actfuns)
+        x = self.linear_layers['l1'](x)
+        x = self.activate(x, 6)
+
+        x = self.linear_layers['l2'](x)
+        x = self.activate(x, 7)
 
         x = self.linear_layers['l3'](x)
 
         return x
 
-    def grouped_fc(self, x, linear_layers):
-        all_outputs = None
-        for group_idx, group_fc in enumerate(linear_layers):
-            group_idx_start = group_idx * int(x.shape[1] / self.g)
-            group_idx_end = (group_idx + 1) * int(x.shape[1] / self.g)
-            curr_inputs = x[:, group_idx_start:group_idx_end]
-            curr_outputs = group_fc(curr_inputs)
-            if group_idx == 0:
-                all_outputs = curr_outputs
-            else:
-                all_outputs = torch.cat((all_outputs, curr_outputs), dim=1)
-        return all_outputs
\ No newline at end of file
+    def activate(self, x, layer):
+        alpha_primes = self.all_alpha_primes[layer] if self.actfun == 'combinact' else None
+        return self.activations[layer](x, alpha_primes)
@@ -16,7 +16,8 @@ class MLP(nn.Module):
                  alpha_dist="per_cluster",
                  permute_type="shuffle",
                  reduce_actfuns=False,
-                 num_params=600000):
+                 num_params=600000,
+                 combinact_recompute=False):
         super(MLP, self).__init__()
 
         if permute_type == 'invert' and p % k != 0:
@@ -27,7 +28,6 @@ class MLP(nn.Module):
         self.p, self.k, self.g = p, k, g
         self.permute_type = permute_type
         self.alpha_dist = alpha_dist
-        self.shuffle_maps = []
         self.reduce_actfuns = reduce_actfuns
         self.iris = True if input_dim == 4 else False
 
@@ -60,9 +60,7 @@ class MLP(nn.Module):
 
         self.linear_layers = nn.ModuleDict()
         self.linear_layers['l1'] = nn.Linear(input_dim, pre_acts[0])
-        self.linear_layers['l2'] = nn.ModuleList()
-        for group in range(g):
-            self.linear_layers['l2'].append(nn.Linear(int(post_acts[0] / g), int(pre_acts[1] / g)))
+        self.linear_layers['l2'] = util.GroupedLinear(int(post_acts[0] / g), int(pre_acts[1] / g), g)
         self.linear_layers['l3'] = nn.Linear(post_acts[1], output_dim)
 
         if not self.iris:
@@ -71,8 +69,20 @@ class MLP(nn.Module):
                 'l2': nn.BatchNorm1d(pre_acts[1])
             })
 
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, pre_acts[0], self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, pre_acts[1], self.p)
+        self.activations = nn.ModuleList([
+            actfuns.HigherOrderActivation(self.actfun, pre_acts[0], p=self.p, k=self.k,
+                                          layer_type='linear',
+                                          permute_type=self.permute_type,
+                                          alpha_dist=self.alpha_dist,
+                                          reduce_actfuns=self.reduce_actfuns,
+                                          combinact_recompute=combinact_recompute),
+            actfuns.HigherOrderActivation(self.actfun, pre_acts[1], p=self.p, k=self.k,
+                                          layer_type='linear',
+                                          permute_type=self.permute_type,
+                                          alpha_dist=self.alpha_dist,
+                                          reduce_actfuns=self.reduce_actfuns,
+                                          combinact_recompute=combinact_recompute)
+        ])
 
         self.all_alpha_primes = nn.ParameterList()
         self.alpha_dist = alpha_dist
@@ -94,17 +104,7 @@ class MLP(nn.Module):
         x = self.activate(x, 0)
         x = x.unsqueeze(0) if len(x.shape) == 1 else x
 
-        all_outputs = None
-        for group_idx, group_fc in enumerate(self.linear_layers['l2']):
-            group_idx_start = group_idx * int(x.shape[1] / self.g)
-            group_idx_end = (group_idx + 1) * int(x.shape[1] / self.g)
-            curr_inputs = x[:, group_idx_start:group_idx_end]
-            curr_outputs = group_fc(curr_inputs)
-            if group_idx == 0:
-                all_outputs = curr_outputs
-            else:
-                all_outputs = torch.cat((all_outputs, curr_outputs), dim=1)
-        x = all_outputs
+        x = self.linear_layers['l2'](x)
         x = self.batch_norms['l2'](x) if not self.iris else x
         x = self.activate(x, 1)
         x = x.unsqueeze(0) if len(x.shape) == 1 else x
@@ -114,15 +114,5 @@ class MLP(nn.Module):
         return x
 
     def activate(self, x, layer):
-        if self.actfun == 'combinact':
-            alpha_primes = self.all_alpha_primes[layer]
-        else:
-            alpha_primes = None
-        return actfuns.activate(x, actfun=self.actfun,
-                                k=self.k, p=self.p, M=x.shape[1],
-                                layer_type='linear',
-                                permute_type=self.permute_type,
-                                shuffle_maps=self.shuffle_maps[layer],
-                                alpha_primes=alpha_primes,
-                                alpha_dist=self.alpha_dist,
-                                reduce_actfuns=self.reduce_actfuns)
\ No newline at end of file
+        alpha_primes = self.all_alpha_primes[layer] if self.actfun == 'combinact' else None
+        return self.activations[layer](x, alpha_primes)
@@ -47,11 +47,16 @@ class BottleneckBlock(nn.Module):
         self.alpha_dist = hyper_params['alpha_dist'] if 'alpha_dist' in hyper_params else 'per_cluster'
         self.permute_type = hyper_params['permute_type'] if 'permute_type' in hyper_params else 'shuffle'
         self.reduce_actfuns = hyper_params['reduce_actfuns'] if 'reduce_actfuns' in hyper_params else False
-
-        self.shuffle_maps = []
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, c_in, self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, c_out, self.p)
-        self.shuffle_maps = util.add_shuffle_map(self.shuffle_maps, c_out, self.p)
+        combinact_recompute = hyper_params['combinact_recompute'] if 'combinact_recompute' in hyper_params else False
+
+        self.activations = nn.ModuleList()
+        for num_nodes in [c_in, out, out]:
+            self.activations.append(actfuns.HigherOrderActivation(self.actfun, num_nodes, p=self.p, k=self.k,
+                                                                  layer_type='conv',
+                                                                  permute_type=self.permute_type,
+                                                                  alpha_dist=self.alpha_dist,
+                                                                  reduce_actfuns=self.reduce_actfuns,
+                                                                  combinact_recompute=combinact_recompute))
         self.all_alpha_primes = nn.ParameterList()  # List of our trainable alpha prime values
         if self.actfun == "combinact":
             self.num_combinact_actfuns = len(actfuns.get_combinact_actfuns(self.reduce_actfuns))
@@ -63,36 +68,24 @@ class BottleneckBlock(nn.Module):
                 for layer in range(3):
                     self.all_alpha_primes.append(nn.Parameter(torch.zeros(self.p, self.num_combinact_actfuns)))
 
-    def activate(self, x, layer_type, shuffle_map, alpha_primes):
-        return actfuns.activate(x,
-                                actfun=self.actfun,
-                                k=self.k,
-                                p=self.p,
-                                M=x.shape[1],
-                                layer_type=layer_type,
-                                permute_type=self.permute_type,
-                                shuffle_maps=shuffle_map,
-                                alpha_primes=alpha_primes,
-                                alpha_dist=self.alpha_dist,
-                                reduce_actfuns=self.reduce_actfuns)
+    def activate(self, x, layer):
+        alpha_primes = self.all_alpha_primes[layer] if self.actfun == 'combinact' else None
+        return self.activations[layer](x, alpha_primes)
 
     def forward(self, x):
 
         identity = x.clone().to(x.device)
 
-        alpha_primes = self.all_alpha_primes[0] if self.actfun == 'combinact' else None
         x = self.bn1(x)
-        x = self.activate(x, 'conv', self.shuffle_maps[0], alpha_primes)
+        x = self.activate(x, 0)
         x = self.conv1(x)
 
-        alpha_primes = self.all_alpha_primes[1] if self.actfun == 'combinact' else None
         x = self.bn2(x)
-        x = self.activate(x, 'conv', self.shuffle_maps[1], alpha_primes)
+        x = self.activate(x, 1)
         x = self.conv2(x)
 
-        alpha_primes = self.all_alpha_primes[2] if self.actfun == 'combinact' else None
         x = self.bn3(x)
-        x = self.activate(x, 'conv', self.shuffle_maps[2], alpha_primes)
+        x = self.activate(x, 2)
         x = self.conv3(x)
 
         if self.proj:
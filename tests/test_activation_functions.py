@@ -0,0 +1,29 @@
+import pytest
+import torch
+import activation_functions as actfuns
+
+
+@pytest.mark.parametrize('layer_type', ['conv', 'linear'])
+def test_fused_lae_matches_logavgexp_under_bf16_autocast(layer_type):
+    generator = torch.Generator().manual_seed(0)
+    shape = (8, 16, 6, 6) if layer_type == 'conv' else (8, 16)
+    # Large values, where reducing in bfloat16 loses most of the precision logavgexp keeps in float32
+    x = (torch.randn(shape, generator=generator) * 4 + 30).bfloat16()
+    grad_output = torch.randn((8, 4) + shape[2:], generator=generator).bfloat16()
+
+    outputs, grads = [], []
+    for fused in [True, False]:
+        z = x.clone().requires_grad_()
+        with torch.autocast('cpu', dtype=torch.bfloat16):
+            if fused:
+                output = actfuns.activate(z, 'lae', p=1, k=4, M=16, layer_type=layer_type)
+            else:
+                output = actfuns.get_activation_fn('lae', 1, 4, layer_type)(z.reshape(8, 4, 4, *shape[2:]), None)
+        output.backward(grad_output)
+        outputs.append(output)
+        grads.append(z.grad)
+
+    assert outputs[0].dtype == outputs[1].dtype == torch.bfloat16
+    # Within one bfloat16 rounding step of each other
+    assert torch.allclose(outputs[0].float(), outputs[1].float(), rtol=2 ** -8, atol=0)
+    assert torch.allclose(grads[0].float(), grads[1].float(), rtol=2 ** -7, atol=2 ** -7)
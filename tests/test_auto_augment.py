@@ -0,0 +1,59 @@
+import random
+import numpy as np
+import pytest
+import torch
+import torch.nn.functional as F
+from PIL import Image
+import auto_augment
+
+
+def get_images(num_images=32, size=32):
+    # Smooth images with some noise, so that the filters and histograms see something like natural images
+    generator = torch.Generator().manual_seed(0)
+    coarse = torch.rand(num_images, 3, size // 4, size // 4, generator=generator) * 255
+    images = F.interpolate(coarse, size=size, mode='bilinear', align_corners=False)
+    images = images + torch.randn(images.shape, generator=generator) * 8
+    return images.clamp(0, 255).to(torch.uint8)
+
+
+def pil_apply(images, operation, magnitude_idx):
+    sub_policy = auto_augment.SubPolicy(1.0, operation, magnitude_idx, 0.0, operation, magnitude_idx)
+    out = []
+    for image in images:
+        img = Image.fromarray(image.permute(1, 2, 0).numpy())
+        out.append(torch.from_numpy(np.array(sub_policy(img))).permute(2, 0, 1))
+    return torch.stack(out)
+
+
+@pytest.mark.parametrize('sign', [1, -1])
+@pytest.mark.parametrize('magnitude_idx', [0, 4, 9])
+@pytest.mark.parametrize('operation', sorted(auto_augment.BATCH_FUNC))
+def test_batch_ops_match_pil_statistics(monkeypatch, operation, magnitude_idx, sign):
+    monkeypatch.setattr(random, 'choice', lambda seq: sign)
+    monkeypatch.setattr(auto_augment, 'random_sign', lambda magnitude: sign * magnitude)
+    images = get_images()
+    magnitude = torch.full((images.shape[0],), float(auto_augment.RANGES[operation][magnitude_idx]))
+
+    expected = pil_apply(images, operation, magnitude_idx).float()
+    actual = auto_augment.BATCH_FUNC[operation](images, magnitude, (128, 128, 128))
+    assert actual.dtype == torch.uint8 and actual.shape == images.shape
+    actual = actual.float()
+
+    dims = (0, 2, 3)
+    assert torch.allclose(actual.mean(dim=dims), expected.mean(dim=dims), atol=0.1)
+    assert torch.allclose(actual.std(dim=dims), expected.std(dim=dims), atol=0.1)
+    assert (actual - expected).abs().mean() < 0.1
+
+
+def test_batch_policy_matches_pil_statistics():
+    images = get_images(num_images=512)
+    random.seed(0)
+    torch.manual_seed(0)
+    pil_policy = auto_augment.CIFAR10Policy()
+    expected = torch.stack([torch.from_numpy(np.array(pil_policy(Image.fromarray(image.permute(1, 2, 0).numpy()))))
+                            .permute(2, 0, 1) for image in images]).float()
+    actual = auto_augment.BatchCIFAR10Policy()(images).float()
+
+    dims = (0, 2, 3)
+    assert torch.allclose(actual.mean(dim=dims), expected.mean(dim=dims), atol=4.0)
+    assert torch.allclose(actual.std(dim=dims), expected.std(dim=dims), atol=4.0)
@@ -0,0 +1,33 @@
+import concurrent.futures
+import os
+import time
+import pytest
+import engine
+
+
+def run_or_fail(job):
+    if job['actfun'] == 'fail':
+        raise RuntimeError('job failed')
+    # The other jobs finish after the failure is seen
+    time.sleep(0.2)
+    return job
+
+
+def test_finish_jobs_records_jobs_finishing_after_a_failure(tmp_path):
+    jobs = [{'actfun': actfun, 'num_params': 0, 'sample_size': 100, 'p': 1, 'k': 2, 'g': 1,
+             'perm_method': 'shuffle', 'curr_seed': seed} for seed, actfun in enumerate(['max', 'fail', 'l2', 'lae'])]
+    ledger_path = str(tmp_path / 'sweep_jobs.jsonl')
+    job_checkpoint_prefix = str(tmp_path / 'sweep')
+    for job in jobs:
+        open(engine.get_job_checkpoint_path(job_checkpoint_prefix, job), 'w').close()
+
+    with concurrent.futures.ThreadPoolExecutor(max_workers=2) as executor:
+        futures = {executor.submit(run_or_fail, job): job for job in jobs}
+        with pytest.raises(RuntimeError, match='job failed'):
+            engine.finish_jobs(futures, ledger_path, job_checkpoint_prefix)
+
+    finished_jobs = engine.load_finished_jobs(ledger_path)
+    assert finished_jobs == set(engine.get_job_key(job) for job in jobs if job['actfun'] != 'fail')
+    # Only the failed job keeps its checkpoint to resume from
+    assert [job['actfun'] for job in jobs
+            if os.path.exists(engine.get_job_checkpoint_path(job_checkpoint_prefix, job))] == ['fail']
@@ -0,0 +1,33 @@
+import pytest
+import torch
+import activation_functions as actfuns
+import trainer
+import util
+
+
+@pytest.mark.parametrize('actfun', actfuns._FUSED_ACTFUNS)
+def test_resnet_width_2_fused_forward(actfun):
+    util.seed_all(0)
+    model, _ = trainer.load_model('resnet', 'cifar10', actfun, k=2, p=1, g=1, num_params=0, perm_method='shuffle',
+                                  device=torch.device('cpu'), resnet_ver=18, resnet_width=2, verbose=False)
+    assert model.layer1[0].activations[1].fused
+    with torch.no_grad():
+        output = model(torch.randn(2, 3, 32, 32))
+    assert output.shape == (2, 10)
+    assert torch.isfinite(output).all()
+
+
+@pytest.mark.parametrize('perm_method', ['shuffle', 'roll', 'roll_grouped', 'invert'])
+def test_resnet_width_2_permuted_forward(perm_method):
+    util.seed_all(0)
+    model, _ = trainer.load_model('resnet', 'cifar10', 'max', k=2, p=2, g=1, num_params=0, perm_method=perm_method,
+                                  device=torch.device('cpu'), resnet_ver=18, resnet_width=2, verbose=False)
+    with torch.no_grad():
+        output = model(torch.randn(2, 3, 32, 32))
+    assert output.shape == (2, 10)
+
+
+def test_fused_mis_sized_activation_raises():
+    activation = actfuns.HigherOrderActivation('max', 8, p=1, k=2, layer_type='conv')
+    with pytest.raises(ValueError, match='16 input channels'):
+        activation(torch.randn(2, 16, 4, 4))
@@ -0,0 +1,47 @@
+import argparse
+import pytest
+import engine
+import util
+
+
+def get_sweep_args(**kwargs):
+    args = argparse.Namespace(actfun='pk_test', seed=0, var_n_params=False, num_params=0, var_n_samples=False,
+                              overfit=False, sample_size=50000, var_perm_method=False, perm_method='shuffle',
+                              var_k=False, k=2, var_p=True, p_param_eff=False, var_pg=False, p=1, var_g=False, g=1,
+                              dataset='cifar10', validation=True, batch_size=128, aug=False, batch_aug=False,
+                              aug_cache='', preload=True)
+    for key, value in kwargs.items():
+        setattr(args, key, value)
+    return args
+
+
+def run_sweep(monkeypatch, args):
+    """
+    Loads the data of every job of the sweep grid through a DatasetCache, as trainer.train does
+    :return: the cache and the number of jobs
+    """
+    monkeypatch.setattr(util, 'load_dataset', lambda *args, **kwargs: object())
+    jobs = engine.get_sweep_jobs(args, util.get_actfuns(args.actfun))
+    dataset_cache = util.DatasetCache()
+    dataset_cache.size_for_sweep(args, jobs)
+    for job in jobs:
+        dataset_cache.load_dataset(args, 'cnn', args.dataset, seed=job['curr_seed'], validation=args.validation,
+                                   batch_size=args.batch_size, train_sample_size=job['sample_size'], kwargs={},
+                                   device='cpu')
+    return dataset_cache, len(jobs)
+
+
+@pytest.mark.parametrize('var_n_samples', [False, True])
+def test_dataset_cache_hits_seed_independent_sweep(monkeypatch, var_n_samples):
+    args = get_sweep_args(var_n_samples=var_n_samples)
+    dataset_cache, num_jobs = run_sweep(monkeypatch, args)
+    num_sample_sizes = len(util.get_train_samples(args))
+    assert dataset_cache.misses == num_sample_sizes
+    assert dataset_cache.hits == num_jobs - num_sample_sizes
+
+
+def test_dataset_cache_keeps_seeded_data_apart(monkeypatch):
+    # The random training samples drawn from the test split runs differ per seed
+    args = get_sweep_args(validation=False)
+    dataset_cache, num_jobs = run_sweep(monkeypatch, args)
+    assert dataset_cache.misses == num_jobs
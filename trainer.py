@@ -18,6 +18,7 @@ from models import cnn
 from models import preact_resnet
 import util
 import hparams
+from cutout import BatchCutout
 
 import numpy as np
 import csv
@@ -26,7 +27,8 @@ import os
 
 
 # -------------------- Loading Model
-def load_model(model, dataset, actfun, k, p, g, num_params, perm_method, device, resnet_ver, resnet_width, verbose):
+def load_model(model, dataset, actfun, k, p, g, num_params, perm_method, device, resnet_ver, resnet_width, verbose,
+               combinact_recompute=False):
 
     model_params = []
 
@@ -53,7 +55,8 @@ def load_model(model, dataset, actfun, k, p, g, num_params, perm_method, device,
                         p=p,
                         g=g,
                         num_params=num_params,
-                        permute_type=perm_method).to(device)
+                        permute_type=perm_method,
+                        combinact_recompute=combinact_recompute).to(device)
         model_params.append({'params': model.batch_norms.parameters(), 'weight_decay': 0})
         model_params.append({'params': model.linear_layers.parameters()})
         if actfun == 'combinact':
@@ -68,7 +71,8 @@ def load_model(model, dataset, actfun, k, p, g, num_params, perm_method, device,
                         p=p,
                         g=g,
                         num_params=num_params,
-                        permute_type=perm_method).to(device)
+                        permute_type=perm_method,
+                        combinact_recompute=combinact_recompute).to(device)
 
         model_params.append({'params': model.conv_layers.parameters()})
         model_params.append({'params': model.pooling.parameters()})
@@ -87,17 +91,39 @@ def load_model(model, dataset, actfun, k, p, g, num_params, perm_method, device,
                                            g=g,
                                            permute_type=perm_method,
                                            width=resnet_width,
-                                           verbose=verbose).to(device)
+                                           verbose=verbose,
+                                           combinact_recompute=combinact_recompute).to(device)
 
         model_params = model.parameters()
 
     return model, model_params
 
 
+def evaluate(model, loaders, criterion, device):
+    """
+    Evaluates several loaders in lockstep, e.g. the clean and augmented views of a data set, with a single forward
+    pass over their concatenated batches
+    :param model: model to evaluate, already in eval mode
+    :param loaders: data loaders with the same number of batches
+    :param criterion: loss function
+    :param device: device the model is on
+    :return: list of the mean batch loss and accuracy over each loader
+    """
+    all_metrics = [util.EpochMetrics(device) for _ in loaders]
+    with torch.no_grad():
+        for batches in zip(*loaders):
+            x = torch.cat([x for x, _ in batches]).to(device)
+            outputs = model(x).split([target.shape[0] for _, target in batches])
+            for metrics, output, (_, target) in zip(all_metrics, outputs, batches):
+                target = target.to(device)
+                metrics.update(criterion(output, target), output, target)
+    return [metrics.compute() for metrics in all_metrics]
+
+
 # -------------------- Setting Up & Running Training Function
 def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location, best_checkpoint_location,
           actfun, curr_seed, outfile_path, filename, fieldnames, curr_sample_size, device, num_params,
-          curr_k=2, curr_p=1, curr_g=1, perm_method='shuffle'):
+          curr_k=2, curr_p=1, curr_g=1, perm_method='shuffle', dataset_cache=None):
     """
     Runs training session for a given randomized model
     :param args: arguments for this job
@@ -113,6 +139,7 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
     :param curr_p: p value for this iteration
     :param curr_g: g value for this iteration
     :param perm_method: permutation strategy for our network
+    :param dataset_cache: util.DatasetCache to reuse loaders from, or None to always build them
     :return:
     """
 
@@ -123,16 +150,18 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
     actfuns_1d = ['relu', 'abs', 'swish', 'leaky_relu', 'tanh']
     if actfun in actfuns_1d:
         curr_k = 1
-    kwargs = {'num_workers': 1, 'pin_memory': True} if torch.cuda.is_available() else {}
+    kwargs = util.get_loader_kwargs(args, device)
+    load_dataset = util.load_dataset if dataset_cache is None else dataset_cache.load_dataset
 
     if args.one_shot:
         util.seed_all(curr_seed)
         model_temp, _ = load_model(args.model, args.dataset, actfun, curr_k, curr_p, curr_g, num_params=num_params,
                                    perm_method=perm_method, device=device, resnet_ver=resnet_ver,
-                                   resnet_width=resnet_width, verbose=args.verbose)
+                                   resnet_width=resnet_width, verbose=args.verbose,
+                                   combinact_recompute=args.combinact_recompute)
 
         util.seed_all(curr_seed)
-        dataset_temp = util.load_dataset(
+        dataset_temp = load_dataset(
             args,
             args.model,
             args.dataset,
@@ -140,7 +169,8 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
             validation=True,
             batch_size=args.batch_size,
             train_sample_size=curr_sample_size,
-            kwargs=kwargs)
+            kwargs=kwargs,
+            device=device)
 
         curr_hparams = hparams.get_hparams(args.model, args.dataset, actfun, curr_seed,
                                            num_epochs, args.search, args.hp_idx, args.one_shot)
@@ -177,13 +207,14 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
         criterion = nn.CrossEntropyLoss()
         model, model_params = load_model(args.model, args.dataset, actfun, curr_k, curr_p, curr_g, num_params=num_params,
                                    perm_method=perm_method, device=device, resnet_ver=resnet_ver,
-                                   resnet_width=resnet_width, verbose=args.verbose)
+                                   resnet_width=resnet_width, verbose=args.verbose,
+                                   combinact_recompute=args.combinact_recompute)
 
         util.seed_all(curr_seed)
         model.apply(util.weights_init)
 
         util.seed_all(curr_seed)
-        dataset = util.load_dataset(
+        dataset = load_dataset(
             args,
             args.model,
             args.dataset,
@@ -191,7 +222,8 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
             validation=args.validation,
             batch_size=args.batch_size,
             train_sample_size=curr_sample_size,
-            kwargs=kwargs)
+            kwargs=kwargs,
+            device=device)
         loaders = {
             'aug_train': dataset[0],
             'train': dataset[1],
@@ -255,65 +287,69 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
         if args.mix_pre_apex:
             model, optimizer = amp.initialize(model, optimizer, opt_level="O2")
 
+        forward_model = model
+        if args.compile:
+            forward_model = torch.compile(model)
+
+        cutout = None
+        if args.cutout_holes > 0:
+            cutout = BatchCutout(args.cutout_holes, args.cutout_length)
+
+        timer = util.PhaseTimer(device, sync=args.profile)
+
         # ---- Start Training
         while epoch <= num_epochs:
 
-            if args.check_path != '':
-                torch.save({'state_dict': model.state_dict(),
-                            'optimizer': optimizer.state_dict(),
-                            'scheduler': scheduler.state_dict(),
-                            'curr_seed': curr_seed,
-                            'epoch': epoch,
-                            'actfun': actfun,
-                            'num_params': num_params,
-                            'sample_size': sample_size,
-                            'p': curr_p, 'k': curr_k, 'g': curr_g,
-                            'perm_method': perm_method
-                            }, mid_checkpoint_location)
-
             util.seed_all((curr_seed * args.num_epochs) + epoch)
+            util.set_aug_cache_epoch([loaders['aug_train'], loaders['aug_eval']], epoch)
+            util.reset_peak_memory(device)
             start_time = time.time()
             if args.mix_pre:
                 scaler = torch.cuda.amp.GradScaler()
 
             # ---- Training
             model.train()
-            total_train_loss, n, num_correct, num_total = 0, 0, 0, 0
+            train_metrics = util.EpochMetrics(device)
+            timer.reset()
             for batch_idx, (x, targetx) in enumerate(loaders['aug_train']):
                 # print(batch_idx)
+                timer.lap('data')
                 x, targetx = x.to(device), targetx.to(device)
+                timer.lap('h2d')
+                if cutout is not None:
+                    x = cutout(x)
+                    timer.lap('data')
                 optimizer.zero_grad()
                 if args.mix_pre:
                     with torch.cuda.amp.autocast():
-                        output = model(x)
+                        output = forward_model(x)
                         train_loss = criterion(output, targetx)
-                    total_train_loss += train_loss
-                    n += 1
+                    timer.lap('forward')
                     scaler.scale(train_loss).backward()
+                    timer.lap('backward')
                     scaler.step(optimizer)
                     scaler.update()
                 elif args.mix_pre_apex:
-                    output = model(x)
+                    output = forward_model(x)
                     train_loss = criterion(output, targetx)
-                    total_train_loss += train_loss
-                    n += 1
+                    timer.lap('forward')
                     with amp.scale_loss(train_loss, optimizer) as scaled_loss:
                         scaled_loss.backward()
+                    timer.lap('backward')
                     optimizer.step()
                 else:
-                    output = model(x)
+                    output = forward_model(x)
                     train_loss = criterion(output, targetx)
-                    total_train_loss += train_loss
-                    n += 1
+                    timer.lap('forward')
                     train_loss.backward()
+                    timer.lap('backward')
                     optimizer.step()
                 if args.optim == 'onecycle' or args.optim == 'onecycle_sgd':
                     scheduler.step()
-                _, prediction = torch.max(output.data, 1)
-                num_correct += torch.sum(prediction == targetx.data)
-                num_total += len(prediction)
-            epoch_aug_train_loss = total_train_loss / n
-            epoch_aug_train_acc = num_correct * 1.0 / num_total
+                train_metrics.update(train_loss, output, targetx)
+                timer.lap('step')
+            epoch_aug_train_loss, epoch_aug_train_acc = train_metrics.compute()
+            samples_per_sec = train_metrics.num_total / (time.time() - start_time)
 
             alpha_primes = []
             alphas = []
@@ -325,33 +361,24 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
                     alpha_primes.append(curr_alpha_primes)
                     alphas.append(curr_alphas)
 
+            # Without augmentations the aug loaders apply the same transforms as the clean ones, so their results
+            # are the same and are not computed twice
             model.eval()
-            with torch.no_grad():
-                total_val_loss, n, num_correct, num_total = 0, 0, 0, 0
-                for batch_idx, (y, targety) in enumerate(loaders['aug_eval']):
-                    y, targety = y.to(device), targety.to(device)
-                    output = model(y)
-                    val_loss = criterion(output, targety)
-                    total_val_loss += val_loss
-                    n += 1
-                    _, prediction = torch.max(output.data, 1)
-                    num_correct += torch.sum(prediction == targety.data)
-                    num_total += len(prediction)
-                epoch_aug_val_loss = total_val_loss / n
-                epoch_aug_val_acc = num_correct * 1.0 / num_total
-
-                total_val_loss, n, num_correct, num_total = 0, 0, 0, 0
-                for batch_idx, (y, targety) in enumerate(loaders['eval']):
-                    y, targety = y.to(device), targety.to(device)
-                    output = model(y)
-                    val_loss = criterion(output, targety)
-                    total_val_loss += val_loss
-                    n += 1
-                    _, prediction = torch.max(output.data, 1)
-                    num_correct += torch.sum(prediction == targety.data)
-                    num_total += len(prediction)
-                epoch_val_loss = total_val_loss / n
-                epoch_val_acc = num_correct * 1.0 / num_total
+            eval_loaders = [loaders['eval']]
+            aug_eval = args.aug and args.aug_eval_every > 0 and (epoch % args.aug_eval_every == 0 or
+                                                                 epoch == num_epochs)
+            if aug_eval:
+                eval_loaders.append(loaders['aug_eval'])
+            timer.mark()
+            eval_results = evaluate(forward_model, eval_loaders, criterion, device)
+            timer.lap('eval')
+            epoch_val_loss, epoch_val_acc = eval_results[0]
+            if not args.aug:
+                epoch_aug_val_loss, epoch_aug_val_acc = epoch_val_loss, epoch_val_acc
+            elif aug_eval:
+                epoch_aug_val_loss, epoch_aug_val_acc = eval_results[1]
+            else:
+                epoch_aug_val_loss, epoch_aug_val_acc = float('nan'), float('nan')
             lr_curr = 0
             for param_group in optimizer.param_groups:
                 lr_curr = param_group['lr']
@@ -370,77 +397,80 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
             epoch_train_loss = 0
             epoch_train_acc = 0
             if epoch == num_epochs:
-                with torch.no_grad():
-                    total_train_loss, n, num_correct, num_total = 0, 0, 0, 0
-                    for batch_idx, (x, targetx) in enumerate(loaders['aug_train']):
-                        x, targetx = x.to(device), targetx.to(device)
-                        output = model(x)
-                        train_loss = criterion(output, targetx)
-                        total_train_loss += train_loss
-                        n += 1
-                        _, prediction = torch.max(output.data, 1)
-                        num_correct += torch.sum(prediction == targetx.data)
-                        num_total += len(prediction)
-                    epoch_aug_train_loss = total_train_loss / n
-                    epoch_aug_train_acc = num_correct * 1.0 / num_total
-
-                    total_train_loss, n, num_correct, num_total = 0, 0, 0, 0
-                    for batch_idx, (x, targetx) in enumerate(loaders['train']):
-                        x, targetx = x.to(device), targetx.to(device)
-                        output = model(x)
-                        train_loss = criterion(output, targetx)
-                        total_train_loss += train_loss
-                        n += 1
-                        _, prediction = torch.max(output.data, 1)
-                        num_correct += torch.sum(prediction == targetx.data)
-                        num_total += len(prediction)
-                    epoch_train_loss = total_val_loss / n
-                    epoch_train_acc = num_correct * 1.0 / num_total
-
-            # Outputting data to CSV at end of epoch
-            with open(outfile_path, mode='a') as out_file:
-                writer = csv.DictWriter(out_file, fieldnames=fieldnames, lineterminator='\n')
-                writer.writerow({'dataset': args.dataset,
-                                 'seed': curr_seed,
-                                 'epoch': epoch,
-                                 'time': (time.time() - start_time),
-                                 'actfun': model.actfun,
-                                 'sample_size': sample_size,
-                                 'model': args.model,
-                                 'batch_size': batch_size,
-                                 'alpha_primes': alpha_primes,
-                                 'alphas': alphas,
-                                 'num_params': util.get_model_params(model),
-                                 'var_nparams': args.var_n_params,
-                                 'var_nsamples': args.var_n_samples,
-                                 'k': curr_k,
-                                 'p': curr_p,
-                                 'g': curr_g,
-                                 'perm_method': perm_method,
-                                 'gen_gap': float(epoch_val_loss - epoch_train_loss),
-                                 'aug_gen_gap': float(epoch_aug_val_loss - epoch_aug_train_loss),
-                                 'resnet_ver': resnet_ver,
-                                 'resnet_width': resnet_width,
-                                 'epoch_train_loss': float(epoch_train_loss),
-                                 'epoch_train_acc': float(epoch_train_acc),
-                                 'epoch_aug_train_loss': float(epoch_aug_train_loss),
-                                 'epoch_aug_train_acc': float(epoch_aug_train_acc),
-                                 'epoch_val_loss': float(epoch_val_loss),
-                                 'epoch_val_acc': float(epoch_val_acc),
-                                 'epoch_aug_val_loss': float(epoch_aug_val_loss),
-                                 'epoch_aug_val_acc': float(epoch_aug_val_acc),
-                                 'hp_idx': hp_idx,
-                                 'curr_lr': lr_curr,
-                                 'found_lr': lr,
-                                 'hparams': curr_hparams,
-                                 'epochs': num_epochs
-                                 })
+                train_loaders = [loaders['train']] if not args.aug else [loaders['train'], loaders['aug_train']]
+                timer.mark()
+                train_results = evaluate(forward_model, train_loaders, criterion, device)
+                timer.lap('eval')
+                epoch_train_loss, epoch_train_acc = train_results[0]
+                epoch_aug_train_loss, epoch_aug_train_acc = train_results[-1]
+
+            # Outputting data to CSV at end of epoch, once the epoch's checkpoints are saved and timed
+            row = {'dataset': args.dataset,
+                   'seed': curr_seed,
+                   'epoch': epoch,
+                   'time': (time.time() - start_time),
+                   'actfun': model.actfun,
+                   'sample_size': sample_size,
+                   'model': args.model,
+                   'batch_size': batch_size,
+                   'alpha_primes': alpha_primes,
+                   'alphas': alphas,
+                   'num_params': util.get_model_params(model),
+                   'var_nparams': args.var_n_params,
+                   'var_nsamples': args.var_n_samples,
+                   'k': curr_k,
+                   'p': curr_p,
+                   'g': curr_g,
+                   'perm_method': perm_method,
+                   'gen_gap': float(epoch_val_loss - epoch_train_loss),
+                   'aug_gen_gap': float(epoch_aug_val_loss - epoch_aug_train_loss),
+                   'resnet_ver': resnet_ver,
+                   'resnet_width': resnet_width,
+                   'epoch_train_loss': float(epoch_train_loss),
+                   'epoch_train_acc': float(epoch_train_acc),
+                   'epoch_aug_train_loss': float(epoch_aug_train_loss),
+                   'epoch_aug_train_acc': float(epoch_aug_train_acc),
+                   'epoch_val_loss': float(epoch_val_loss),
+                   'epoch_val_acc': float(epoch_val_acc),
+                   'epoch_aug_val_loss': float(epoch_aug_val_loss),
+                   'epoch_aug_val_acc': float(epoch_aug_val_acc),
+                   'hp_idx': hp_idx,
+                   'curr_lr': lr_curr,
+                   'found_lr': lr,
+                   'hparams': curr_hparams,
+                   'epochs': num_epochs,
+                   'data_time': timer.get('data'),
+                   'h2d_time': timer.get('h2d'),
+                   'forward_time': timer.get('forward'),
+                   'backward_time': timer.get('backward'),
+                   'step_time': timer.get('step'),
+                   'eval_time': timer.get('eval'),
+                   'samples_per_sec': samples_per_sec,
+                   'peak_memory_mb': util.get_peak_memory(device)
+                   }
 
             epoch += 1
 
             if args.optim == 'rmsprop':
                 scheduler.step()
 
+            # The resume checkpoint is saved to a temporary file, which keeps the previous checkpoint intact if the job
+            # is killed mid-save, and only replaces it once the epoch's results are written, so a resumed job never
+            # repeats an epoch
+            checkpoint_start_time = time.time()
+            if args.check_path != '':
+                torch.save({'state_dict': model.state_dict(),
+                            'optimizer': optimizer.state_dict(),
+                            'scheduler': scheduler.state_dict(),
+                            'curr_seed': curr_seed,
+                            'epoch': epoch,
+                            'actfun': actfun,
+                            'num_params': num_params,
+                            'sample_size': sample_size,
+                            'p': curr_p, 'k': curr_k, 'g': curr_g,
+                            'perm_method': perm_method
+                            }, mid_checkpoint_location + '.tmp')
+
             if args.checkpoints:
                 if epoch_val_acc > best_val_acc:
                     best_val_acc = epoch_val_acc
@@ -467,3 +497,10 @@ def train(args, checkpoint, mid_checkpoint_location, final_checkpoint_location,
                             'p': curr_p, 'k': curr_k, 'g': curr_g,
                             'perm_method': perm_method
                             }, final_checkpoint_location)
+            row['checkpoint_time'] = time.time() - checkpoint_start_time
+
+            with open(outfile_path, mode='a') as out_file:
+                writer = csv.DictWriter(out_file, fieldnames=fieldnames, lineterminator='\n')
+                writer.writerow(row)
+            if args.check_path != '':
+                os.replace(mid_checkpoint_location + '.tmp', mid_checkpoint_location)
@@ -1,18 +1,22 @@
 import torch
 import torch.utils.data
 import torch.nn as nn
+import torch.nn.functional as F
 import torchvision.datasets as datasets
 import torchvision.transforms as transforms
 
 import numpy as np
+from PIL import Image
 import random
+import math
 import activation_functions as actfuns
-from auto_augment import CIFAR10Policy
-from collections import namedtuple
+from auto_augment import CIFAR10Policy, BatchCIFAR10Policy
+from collections import namedtuple, OrderedDict
 from sklearn import model_selection
 from sklearn.datasets import load_iris
 import os
 import csv
+import time
 try:
     from torch_lr_finder import LRFinder
     import matplotlib.pyplot as plt
@@ -122,11 +126,100 @@ def weights_init(m):
     :return:
     """
     irange = 0.005
-    if type(m) == nn.Linear:
+    if type(m) == nn.Linear or type(m) == GroupedLinear:
         m.weight.data.uniform_(-1 * irange, irange)
         m.bias.data.fill_(0)
 
 
+class EpochMetrics:
+    """
+    Running loss and accuracy over an epoch, summed on the device so that batches never wait on a host sync
+    """
+
+    def __init__(self, device):
+        self.total_loss = torch.zeros((), device=device)
+        self.num_correct = torch.zeros((), dtype=torch.long, device=device)
+        self.num_batches = 0
+        self.num_total = 0
+
+    def update(self, loss, output, target):
+        """
+        :param loss: mean loss of the batch
+        :param output: model outputs for the batch
+        :param target: labels for the batch
+        :return:
+        """
+        self.total_loss += loss.detach()
+        self.num_correct += (output.detach().argmax(dim=1) == target).sum()
+        self.num_batches += 1
+        self.num_total += target.shape[0]
+
+    def compute(self):
+        """
+        :return: mean batch loss and accuracy, read back from the device in a single sync
+        """
+        loss, acc = torch.stack([self.total_loss / self.num_batches,
+                                 self.num_correct * 1.0 / self.num_total]).tolist()
+        return loss, acc
+
+
+class PhaseTimer:
+    """
+    Accumulates the wall time of each phase of an epoch between calls to lap.
+    With sync, waits for the GPU at every lap so its asynchronous work is charged to the phase that queued it,
+    otherwise GPU phases only measure the time spent on the host
+    """
+
+    def __init__(self, device, sync=False):
+        """
+        :param device: device trained on
+        :param sync: whether to synchronize the GPU at every lap
+        """
+        self.device = device
+        self.sync = sync and torch.device(device).type == 'cuda'
+        self.totals = {}
+        self.last = time.time()
+
+    def reset(self):
+        self.totals = {}
+        self.mark()
+
+    def mark(self):
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        self.last = time.time()
+
+    def lap(self, phase):
+        """
+        :param phase: phase to charge the time since the previous lap or mark to
+        """
+        if self.sync:
+            torch.cuda.synchronize(self.device)
+        now = time.time()
+        self.totals[phase] = self.totals.get(phase, 0) + now - self.last
+        self.last = now
+
+    def get(self, phase):
+        return self.totals.get(phase, 0)
+
+
+def reset_peak_memory(device):
+    if torch.device(device).type == 'cuda':
+        torch.cuda.reset_peak_memory_stats(device)
+
+
+def get_peak_memory(device):
+    """
+    :param device: device trained on
+    :return: peak memory in MiB, allocated on the GPU since the last reset_peak_memory, or resident for the
+        whole process on CPU
+    """
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2 ** 20
+    import resource
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2 ** 10
+
+
 def get_model_params(model):
     """
     :param model: Pytorch network model
@@ -405,32 +498,134 @@ def test_nn_inputs(actfun, net_struct, in_size):
     return None
 
 
+class GroupedLinear(nn.Module):
+    """
+    g independent linear layers over consecutive slices of the input, evaluated with a single batched matmul.
+    Inputs beyond g * in_features are ignored, as with the per-group nn.Linear loops it replaces
+    """
+
+    def __init__(self, in_features, out_features, groups=1):
+        """
+        :param in_features: number of inputs to each group
+        :param out_features: number of outputs from each group
+        :param groups: number of groups g
+        """
+        super(GroupedLinear, self).__init__()
+        self.in_features = in_features
+        self.out_features = out_features
+        self.groups = groups
+        self.weight = nn.Parameter(torch.empty(groups, out_features, in_features))
+        self.bias = nn.Parameter(torch.empty(groups, out_features))
+        self.reset_parameters()
+
+    def reset_parameters(self):
+        # Initialise group by group, drawing the same random numbers as g separate nn.Linear layers
+        bound = 1 / math.sqrt(self.in_features) if self.in_features > 0 else 0
+        for group in range(self.groups):
+            nn.init.kaiming_uniform_(self.weight[group], a=math.sqrt(5))
+            nn.init.uniform_(self.bias[group], -bound, bound)
+
+    def _load_from_state_dict(self, state_dict, prefix, local_metadata, strict,
+                              missing_keys, unexpected_keys, error_msgs):
+        # Checkpoints saved before grouped layers were batched hold one nn.Linear per group
+        if prefix + 'weight' not in state_dict and prefix + '0.weight' in state_dict:
+            state_dict[prefix + 'weight'] = torch.stack([state_dict.pop('{}{}.weight'.format(prefix, group))
+                                                         for group in range(self.groups)])
+            state_dict[prefix + 'bias'] = torch.stack([state_dict.pop('{}{}.bias'.format(prefix, group))
+                                                       for group in range(self.groups)])
+        super(GroupedLinear, self)._load_from_state_dict(state_dict, prefix, local_metadata, strict,
+                                                         missing_keys, unexpected_keys, error_msgs)
+
+    def forward(self, x):
+        if x.shape[1] != self.groups * self.in_features:
+            x = x[:, :self.groups * self.in_features]
+        if self.groups == 1:
+            return F.linear(x, self.weight.view(self.out_features, self.in_features), self.bias.view(-1))
+        x = x.reshape(x.shape[0], self.groups, self.in_features)
+        x = torch.einsum('bgi,goi->bgo', x, self.weight) + self.bias
+        return x.reshape(x.shape[0], self.groups * self.out_features)
+
+    def extra_repr(self):
+        return 'in_features={}, out_features={}, groups={}'.format(self.in_features, self.out_features, self.groups)
+
+
 def add_shuffle_map(shuffle_maps, num_nodes, p):
     new_maps = []
     for perm in range(p):
         new_maps.append(torch.randperm(num_nodes))
-    shuffle_maps.append(new_maps)
+    shuffle_maps.append(torch.stack(new_maps))
     return shuffle_maps
 
 
+def get_perm_index(shuffle_maps, p, k, method):
+    """
+    Combines all p permutations of a layer into a single gather index, so that x.index_select(1, perm_index)
+    produces every permutation, one full permutation after another, in a single kernel
+    :param shuffle_maps: the p shuffle maps for this layer
+    :param p: number of permutations
+    :param k: group size
+    :param method: permutation method
+    :return: LongTensor of size p * num_nodes, on the same device as the shuffle maps
+    """
+    device = shuffle_maps[0].device
+    num_nodes = shuffle_maps[0].shape[0]
+    if method == 'roll' or method == 'roll_grouped':
+        num_groups = 2 if method == 'roll_grouped' else 1
+        return get_roll_index(num_nodes, torch.arange(p, device=device), num_groups).flatten()
+    if method == 'invert':
+        return get_invert_index(shuffle_maps, p, k).flatten()
+    return torch.cat([torch.arange(num_nodes, device=device)] + [shuffle_maps[i] for i in range(1, p)])
+
+
+def get_invert_index(shuffle_maps, p, k):
+    """
+    Builds the gather indices of the invert permutations in closed form. Every k-th permutation is a shuffle (the
+    identity for the first), and the r-th permutation after it moves element r of each of its groups of k to the
+    front, which is what swapping the first and r-th elements of the previous permutation's groups amounts to
+    :param shuffle_maps: the p shuffle maps for this layer
+    :param p: number of permutations
+    :param k: group size
+    :return: LongTensor of size (p, num_nodes), on the same device as the shuffle maps
+    """
+    device = shuffle_maps[0].device
+    num_nodes = shuffle_maps[0].shape[0]
+    bases = [torch.arange(num_nodes, device=device)] + [shuffle_maps[i] for i in range(k, p, k)]
+    bases = torch.stack(bases).reshape(len(bases), num_nodes // k, k)
+
+    # group_order[r, j] is the element of the base group moved to position j in its r-th inversion
+    r = torch.arange(k, device=device).unsqueeze(1)
+    j = torch.arange(k, device=device)
+    group_order = torch.where(j == 0, r, j - (j <= r).long())
+
+    # (bases, groups, r, j) -> (bases, r, groups, j), so each inversion's groups stay together
+    inverted = bases[:, :, group_order].transpose(1, 2)
+    return inverted.reshape(-1, num_nodes)[:p]
+
+
+def get_roll_index(num_nodes, offsets, num_groups=1):
+    """
+    Builds the gather indices of the roll permutations in closed form. The nodes are split into num_groups equal
+    groups, the last one also taking the remainder, and each group is rolled left by the offset. As with slicing,
+    offsets of a group's size or more leave the group unchanged
+    :param num_nodes: number of nodes
+    :param offsets: LongTensor of roll offsets
+    :param num_groups: number of groups rolled separately
+    :return: LongTensor of size (len(offsets), num_nodes), on the same device as offsets
+    """
+    group_size = num_nodes // num_groups
+    nodes = torch.arange(num_nodes, device=offsets.device)
+    group_start = torch.clamp(nodes // group_size, max=num_groups - 1) * group_size
+    group_sizes = torch.where(group_start == (num_groups - 1) * group_size, num_nodes - group_start, group_size)
+    offsets = offsets.unsqueeze(1)
+    offsets = torch.where(offsets < group_sizes, offsets, 0)
+    return group_start + (nodes - group_start + offsets) % group_sizes
+
+
 def permute(x, method, layer_type, k, offset, num_groups=2, shuffle_map=None):
-    if method == "roll":
-        return torch.cat((x[:, offset:, ...], x[:, :offset, ...]), dim=1)
-    elif method == "roll_grouped":
-        group_size = int(x.shape[1] / num_groups)
-        output = None
-        for i, group in enumerate(range(num_groups)):
-            start = offset + group_size * group
-            if i == num_groups - 1:
-                group_size += x.shape[1] % num_groups
-            end = start + group_size - offset
-            curr_roll = torch.cat((x[:, start:end, ...], x[:, start - offset:start, ...]),
-                                  dim=1)
-            if group == 0:
-                output = curr_roll
-            else:
-                output = torch.cat((output, curr_roll), dim=1)
-        return output
+    if method == "roll" or method == "roll_grouped":
+        offsets = torch.tensor([offset], device=x.device)
+        roll_index = get_roll_index(x.shape[1], offsets, num_groups if method == "roll_grouped" else 1)
+        return x.index_select(1, roll_index[0])
     elif method == "shuffle":
         return x[:, shuffle_map, ...]
     elif method == 'invert':
@@ -454,7 +649,8 @@ def load_dataset(
         validation=False,
         batch_size=None,
         train_sample_size=60000,
-        kwargs=None):
+        kwargs=None,
+        device=None):
 
     seed_all(seed)
 
@@ -487,46 +683,32 @@ def load_dataset(
         return aug_train_loader, train_loader, aug_eval_loader, eval_loader, features_train.shape[0], 1
 
     if dataset == 'mnist':
+        mean, std = (0.1307,), (0.3081,)
         aug_trans, trans = [], []
         if args.aug:
             aug_trans.append(transforms.RandomAffine(degrees=10, scale=(0.8, 1.2), translate=(0.08, 0.08), shear=0.3))
-        aug_trans.append(transforms.ToTensor())
-        aug_trans.append(transforms.Normalize((0.1307,), (0.3081,)))
         trans.append(transforms.ToTensor())
-        trans.append(transforms.Normalize((0.1307,), (0.3081,)))
+        trans.append(transforms.Normalize(mean, std))
 
-        aug_trans_all = transforms.Compose(aug_trans)
+        aug_trans_all = transforms.Compose(aug_trans + trans)
         trans_all = transforms.Compose(trans)
-        aug_train_set = datasets.MNIST(root='./data', train=True, download=True, transform=aug_trans_all)
-        train_set = datasets.MNIST(root='./data', train=True, download=True, transform=trans_all)
-        aug_test_set = datasets.MNIST(root='./data', train=False, download=True, transform=aug_trans_all)
-        test_set = datasets.MNIST(root='./data', train=False, download=True, transform=trans_all)
+        aug_train_set, train_set, aug_test_set, test_set = get_data_sets(args, dataset, aug_trans_all, trans_all)
 
         if batch_size is None:
             batch_size = 256
 
     elif dataset == 'cifar10' or dataset == 'cifar100':
+        mean, std = (0.5, 0.5, 0.5), (0.5, 0.5, 0.5)
         aug_trans, trans = [], []
-        if args.aug:
+        if args.aug and not args.batch_aug:
             aug_trans.append(transforms.RandomHorizontalFlip())
             aug_trans.append(CIFAR10Policy())
-        aug_trans.append(transforms.ToTensor())
-        aug_trans.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
         trans.append(transforms.ToTensor())
-        trans.append(transforms.Normalize((0.5, 0.5, 0.5), (0.5, 0.5, 0.5)))
+        trans.append(transforms.Normalize(mean, std))
 
-        aug_trans_all = transforms.Compose(aug_trans)
+        aug_trans_all = transforms.Compose(aug_trans + trans)
         trans_all = transforms.Compose(trans)
-        if dataset == 'cifar10':
-            aug_train_set = datasets.CIFAR10(root='./data', train=True, download=True, transform=aug_trans_all)
-            train_set = datasets.CIFAR10(root='./data', train=True, download=True, transform=trans_all)
-            aug_test_set = datasets.CIFAR10(root='./data', train=False, download=True, transform=aug_trans_all)
-            test_set = datasets.CIFAR10(root='./data', train=False, download=True, transform=trans_all)
-        elif dataset == 'cifar100':
-            aug_train_set = datasets.CIFAR100(root='./data', train=True, download=True, transform=aug_trans_all)
-            train_set = datasets.CIFAR100(root='./data', train=True, download=True, transform=trans_all)
-            aug_test_set = datasets.CIFAR100(root='./data', train=False, download=True, transform=aug_trans_all)
-            test_set = datasets.CIFAR100(root='./data', train=False, download=True, transform=trans_all)
+        aug_train_set, train_set, aug_test_set, test_set = get_data_sets(args, dataset, aug_trans_all, trans_all)
 
         if batch_size is None:
             batch_size = 256
@@ -557,19 +739,440 @@ def load_dataset(
 
     train_sample_size = train_idx.shape[0]
 
-    aug_train_set = torch.utils.data.Subset(aug_train_set, train_idx)
-    train_set = torch.utils.data.Subset(train_set, train_idx)
-    aug_eval_set = torch.utils.data.Subset(aug_eval_set, val_idx)
-    eval_set = torch.utils.data.Subset(eval_set, val_idx)
+    batch_aug = args.aug and args.batch_aug and dataset != 'mnist'
+    if args.aug and args.aug_cache != '' and not batch_aug:
+        os.makedirs(args.aug_cache, exist_ok=True)
+        cache_prefix = os.path.join(args.aug_cache, '{}-{}'.format(dataset, seed))
+        aug_train_set = AugmentationCache(aug_train_set, transforms.Compose(aug_trans), trans_all,
+                                          cache_prefix + '-train', seed)
+        if validation:
+            aug_eval_set = aug_train_set
+        else:
+            aug_eval_set = AugmentationCache(aug_eval_set, transforms.Compose(aug_trans), trans_all,
+                                             cache_prefix + '-test', seed)
 
-    aug_train_loader = torch.utils.data.DataLoader(aug_train_set, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
-    train_loader = torch.utils.data.DataLoader(train_set, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
-    aug_eval_loader = torch.utils.data.DataLoader(aug_eval_set, batch_size=batch_size, drop_last=False, shuffle=False, **kwargs)
-    eval_loader = torch.utils.data.DataLoader(eval_set, batch_size=batch_size, drop_last=False, shuffle=False, **kwargs)
+    if args.preload or batch_aug:
+        train_images, train_labels = get_preloaded_tensors(train_set, train_idx, device)
+        eval_images, eval_labels = get_preloaded_tensors(eval_set, val_idx, device)
+
+    if args.preload:
+        train_loader = PreloadedLoader(train_images, train_labels, mean, std, batch_size, shuffle=True, drop_last=True)
+        eval_loader = PreloadedLoader(eval_images, eval_labels, mean, std, batch_size, shuffle=False, drop_last=False)
+    else:
+        train_set = torch.utils.data.Subset(train_set, train_idx)
+        eval_set = torch.utils.data.Subset(eval_set, val_idx)
+        train_loader = torch.utils.data.DataLoader(train_set, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
+        eval_loader = torch.utils.data.DataLoader(eval_set, batch_size=batch_size, drop_last=False, shuffle=False, **kwargs)
+
+    if (args.preload and not args.aug) or batch_aug:
+        batch_transforms = [batch_random_horizontal_flip, BatchCIFAR10Policy()] if batch_aug else []
+        aug_train_loader = PreloadedLoader(train_images, train_labels, mean, std, batch_size, shuffle=True,
+                                           drop_last=True, batch_transforms=batch_transforms)
+        aug_eval_loader = PreloadedLoader(eval_images, eval_labels, mean, std, batch_size, shuffle=False,
+                                          drop_last=False, batch_transforms=batch_transforms)
+    else:
+        aug_train_set = torch.utils.data.Subset(aug_train_set, train_idx)
+        aug_eval_set = torch.utils.data.Subset(aug_eval_set, val_idx)
+        aug_train_loader = torch.utils.data.DataLoader(aug_train_set, batch_size=batch_size, drop_last=True, shuffle=True, **kwargs)
+        aug_eval_loader = torch.utils.data.DataLoader(aug_eval_set, batch_size=batch_size, drop_last=False, shuffle=False, **kwargs)
 
     return aug_train_loader, train_loader, aug_eval_loader, eval_loader, train_sample_size, batch_size
 
 
+def get_loader_kwargs(args, device, num_workers=None):
+    """
+    :param args: experiment arguments holding the loader options
+    :param device: device trained on
+    :param num_workers: number of worker processes, overriding args.loader_workers
+    :return: keyword arguments of the DataLoaders
+    """
+    cuda = torch.device(device).type == 'cuda'
+    if num_workers is None:
+        num_workers = args.loader_workers
+    if num_workers is None:
+        num_workers = 1 if cuda else 0
+
+    kwargs = {'num_workers': num_workers, 'pin_memory': cuda and not args.no_pin_memory}
+    if num_workers > 0:
+        kwargs['prefetch_factor'] = args.prefetch_factor
+        kwargs['persistent_workers'] = args.persistent_workers
+    return kwargs
+
+
+def autotune_loader_workers(args, device, seed, sample_size, num_steps):
+    """
+    Times the augmented training loader with each candidate number of workers, up to the CPUs available to the job
+    :param args: experiment arguments holding the loader options
+    :param device: device trained on
+    :param seed: seed to load the data set with
+    :param sample_size: training sample size to load the data set with
+    :param num_steps: number of batches timed per candidate, after the first
+    :return: number of workers giving the most batches per second
+    """
+    num_cpus = len(os.sched_getaffinity(0)) if hasattr(os, 'sched_getaffinity') else os.cpu_count()
+    candidates = [0] + [2 ** i for i in range(int(math.log2(num_cpus)) + 1)]
+    if num_cpus not in candidates:
+        candidates.append(num_cpus)
+
+    loader = load_dataset(args, args.model, args.dataset, seed=seed, validation=args.validation,
+                          batch_size=args.batch_size, train_sample_size=sample_size,
+                          kwargs=get_loader_kwargs(args, device, 0), device=device)[0]
+    if not isinstance(loader, torch.utils.data.DataLoader):
+        return args.loader_workers
+
+    best_workers, best_rate = None, 0
+    for num_workers in candidates:
+        candidate_loader = torch.utils.data.DataLoader(loader.dataset, batch_size=loader.batch_size, shuffle=True,
+                                                       drop_last=True, **get_loader_kwargs(args, device, num_workers))
+        batches = iter(candidate_loader)
+        # The first batch waits on the workers starting up, paid once when they persist
+        next(batches)
+        start_time = time.time()
+        num_batches = 0
+        for x, _ in batches:
+            x.to(device)
+            num_batches += 1
+            if num_batches == num_steps:
+                break
+        rate = num_batches / (time.time() - start_time)
+        print("Loader workers: {}, batches/s: {:.1f}".format(num_workers, rate))
+        if rate > best_rate:
+            best_workers, best_rate = num_workers, rate
+        del batches
+    print("Using {} loader workers".format(best_workers))
+    return best_workers
+
+
+class DatasetCache:
+    """
+    Keeps the loaders built by load_dataset for the most recent settings, so sweep jobs sharing a data set,
+    sample size, validation split, batch size and augmentation reuse them rather than rebuilding them. The seed is
+    only part of the setting when the loaded data depends on it
+    """
+
+    def __init__(self, max_size=2):
+        """
+        :param max_size: number of settings whose loaders are kept, dropping the least recently used
+        """
+        self.max_size = max_size
+        self.entries = OrderedDict()
+        self.hits, self.misses = 0, 0
+
+    @staticmethod
+    def depends_on_seed(args, dataset, validation):
+        """
+        :return: whether load_dataset loads different data for different seeds, i.e. it draws a random training
+            sample from the whole training set, or reads an augmentation cache kept per seed
+        """
+        batch_aug = args.aug and args.batch_aug and dataset != 'mnist'
+        return not validation or (args.aug and args.aug_cache != '' and not batch_aug)
+
+    def size_for_sweep(self, args, jobs):
+        """
+        Grows the cache to one entry per training sample size of the sweep jobs, when the loaded data does not
+        depend on the per-job seed. Seeded data would need an entry per job, so the cache is left as it is
+        :param jobs: jobs from engine.get_sweep_jobs
+        """
+        if not self.depends_on_seed(args, args.dataset, args.validation):
+            self.max_size = max(self.max_size, len(set(job['sample_size'] for job in jobs)))
+
+    def load_dataset(self, args, model, dataset, seed=0, validation=False, batch_size=None, train_sample_size=60000,
+                     kwargs=None, device=None):
+        """
+        Drop-in replacement of load_dataset. Random states are left as load_dataset leaves them, so runs
+        are the same whether or not the loaders came from the cache. When the data does not depend on the seed,
+        load_dataset draws nothing after seeding, so seeding is all a cache hit has to do
+        """
+        depends_on_seed = self.depends_on_seed(args, dataset, validation)
+        key = (dataset, train_sample_size, validation, batch_size, args.aug, seed if depends_on_seed else None,
+               str(device))
+        if key in self.entries:
+            self.hits += 1
+            self.entries.move_to_end(key)
+            loaders, random_states = self.entries[key]
+            seed_all(seed)
+            if random_states is not None:
+                random.setstate(random_states[0])
+                np.random.set_state(random_states[1])
+                torch.set_rng_state(random_states[2])
+            return loaders
+
+        self.misses += 1
+        loaders = load_dataset(args, model, dataset, seed=seed, validation=validation, batch_size=batch_size,
+                               train_sample_size=train_sample_size, kwargs=kwargs, device=device)
+        random_states = None
+        if depends_on_seed:
+            random_states = random.getstate(), np.random.get_state(), torch.get_rng_state()
+        self.entries[key] = loaders, random_states
+        while len(self.entries) > self.max_size:
+            self.entries.popitem(last=False)
+        return loaders
+
+
+TORCHVISION_SETS = {
+    'mnist': datasets.MNIST,
+    'cifar10': datasets.CIFAR10,
+    'cifar100': datasets.CIFAR100
+}
+
+
+def get_data_sets(args, dataset, aug_transform, transform):
+    """
+    :param args: experiment arguments, reading from the memory-mapped store in args.data_store if set
+    :param dataset: mnist, cifar10 or cifar100
+    :param aug_transform: transform of the augmented sets
+    :param transform: transform of the plain sets
+    :return: augmented train set, train set, augmented test set, test set
+    """
+    if args.data_store != '':
+        train_prefix = convert_data_set(args.data_store, dataset, train=True)
+        test_prefix = convert_data_set(args.data_store, dataset, train=False)
+        return (MmapDataset(train_prefix, transform=aug_transform), MmapDataset(train_prefix, transform=transform),
+                MmapDataset(test_prefix, transform=aug_transform), MmapDataset(test_prefix, transform=transform))
+
+    data_class = TORCHVISION_SETS[dataset]
+    return (data_class(root='./data', train=True, download=True, transform=aug_transform),
+            data_class(root='./data', train=True, download=True, transform=transform),
+            data_class(root='./data', train=False, download=True, transform=aug_transform),
+            data_class(root='./data', train=False, download=True, transform=transform))
+
+
+def convert_data_set(data_store, dataset, train):
+    """
+    Writes the images and labels of a torchvision data set to flat .npy files, unless already converted
+    :param data_store: directory of the converted data sets
+    :param dataset: mnist, cifar10 or cifar100
+    :param train: whether to convert the train or the test split
+    :return: path prefix of the images and labels files
+    """
+    prefix = os.path.join(data_store, '{}-{}'.format(dataset, 'train' if train else 'test'))
+    if not os.path.exists(prefix + '-labels.npy'):
+        os.makedirs(data_store, exist_ok=True)
+        data_set = TORCHVISION_SETS[dataset](root='./data', train=train, download=True)
+        # Labels are written last, marking the conversion as complete
+        for suffix, array in [('-images.npy', np.asarray(data_set.data, dtype=np.uint8)),
+                              ('-labels.npy', np.asarray(data_set.targets, dtype=np.int64))]:
+            tmp_path = '{}{}.{}.tmp'.format(prefix, suffix, os.getpid())
+            with open(tmp_path, 'wb') as tmp_file:
+                np.save(tmp_file, array)
+            os.replace(tmp_path, prefix + suffix)
+    return prefix
+
+
+class MmapDataset(torch.utils.data.Dataset):
+    """
+    MNIST or CIFAR data set read from the flat .npy files written by convert_data_set.
+    The files are memory-mapped, so data sets and worker processes reading the same files share their pages,
+    and samples are zero-copy views until transformed. Mirrors the data, targets and transform attributes of
+    the torchvision data sets
+    """
+
+    def __init__(self, prefix, transform=None):
+        """
+        :param prefix: path prefix of the images and labels files
+        :param transform: transform applied to the PIL images
+        """
+        self.prefix = prefix
+        self.transform = transform
+        self.open()
+
+    def open(self):
+        self.data = np.load(self.prefix + '-images.npy', mmap_mode='r')
+        self.targets = np.load(self.prefix + '-labels.npy', mmap_mode='r')
+
+    def __getstate__(self):
+        # Worker processes map the files again rather than receiving a copy of the data
+        state = self.__dict__.copy()
+        del state['data'], state['targets']
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.open()
+
+    def __len__(self):
+        return self.data.shape[0]
+
+    def __getitem__(self, index):
+        img = Image.fromarray(self.data[index])
+        if self.transform is not None:
+            img = self.transform(img)
+        return img, int(self.targets[index])
+
+
+def get_preloaded_tensors(data_set, indices, device):
+    """
+    :param data_set: MNIST or CIFAR torchvision data set
+    :param indices: indices of the samples to keep
+    :param device: device to hold the samples on
+    :return: uint8 images of shape (N, C, H, W) and labels, both on the device
+    """
+    images = torch.as_tensor(data_set.data[indices])
+    if images.dim() == 3:
+        images = images.unsqueeze(1)
+    else:
+        images = images.permute(0, 3, 1, 2)
+    labels = torch.as_tensor(np.asarray(data_set.targets)[indices])
+    return images.contiguous().to(device), labels.to(device)
+
+
+class AugmentationCache(torch.utils.data.Dataset):
+    """
+    Memory-mapped store of augmented uint8 images, keyed by data set, split, seed, epoch and index.
+    Each image is augmented and stored the first time it is read, and replayed by every later run with the same seed.
+    Augmentations are seeded from their key, so filling the cache and replaying it train identically
+    """
+
+    def __init__(self, data_set, augment, transform, cache_prefix, seed):
+        """
+        :param data_set: MNIST or CIFAR torchvision data set, whose own transform is dropped
+        :param augment: PIL augmentations whose results are cached
+        :param transform: transforms applied to the cached images, i.e. ToTensor and Normalize
+        :param cache_prefix: path prefix of the per epoch cache files
+        :param seed: seed of the run, part of the key
+        """
+        data_set.transform = None
+        self.data_set = data_set
+        self.augment = augment
+        self.transform = transform
+        self.cache_prefix = cache_prefix
+        self.seed = seed
+        # Shared with the worker processes, which outlive an epoch when persistent
+        self.epoch = torch.ones(1, dtype=torch.long).share_memory_()
+        self.images = None
+        self.cached = None
+        self.open_epoch = None
+
+    def __len__(self):
+        return len(self.data_set)
+
+    def __getstate__(self):
+        # Worker processes open their own maps of the cache files
+        state = self.__dict__.copy()
+        state['images'], state['cached'], state['open_epoch'] = None, None, None
+        return state
+
+    def set_epoch(self, epoch):
+        self.epoch.fill_(epoch)
+
+    def __getitem__(self, index):
+        epoch = int(self.epoch)
+        if self.open_epoch != epoch:
+            cache_path = '{}-{}'.format(self.cache_prefix, epoch)
+            num_images = len(self.data_set)
+            self.images = open_cache_array(cache_path + '.npy', (num_images,) + tuple(self.data_set.data.shape[1:]))
+            self.cached = open_cache_array(cache_path + '_cached.npy', (num_images,))
+            self.open_epoch = epoch
+
+        if self.cached[index]:
+            img, target = self.images[index], int(self.data_set.targets[index])
+        else:
+            img, target = self.data_set[index]
+            img = self.augment_image(img, index, epoch)
+            self.images[index] = img
+            self.cached[index] = 1
+        return self.transform(img), target
+
+    def augment_image(self, img, index, epoch):
+        # Leaves the global random states as they were, as replayed images do not draw from them. The augmentations
+        # run on the CPU, so only the CPU generator is seeded; torch.manual_seed would also reseed the CUDA generators,
+        # which fork_rng(devices=[]) does not restore
+        aug_seed = hash((self.seed, epoch, index)) % (2 ** 63)
+        random_state = random.getstate()
+        with torch.random.fork_rng(devices=[]):
+            random.seed(aug_seed)
+            torch.default_generator.manual_seed(aug_seed)
+            img = np.array(self.augment(img))
+        random.setstate(random_state)
+        return img
+
+
+def open_cache_array(path, shape):
+    """
+    :param path: path of the .npy file
+    :param shape: shape of the array, created zero filled if the file does not exist yet
+    :return: uint8 array memory-mapped for reading and writing
+    """
+    if not os.path.exists(path):
+        # Linking never replaces a file another process has created in the meantime
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        np.lib.format.open_memmap(tmp_path, mode='w+', dtype=np.uint8, shape=shape).flush()
+        try:
+            os.link(tmp_path, path)
+        except FileExistsError:
+            pass
+        os.remove(tmp_path)
+    return np.lib.format.open_memmap(path, mode='r+')
+
+
+def set_aug_cache_epoch(loaders, epoch):
+    """
+    :param loaders: data loaders, whose augmentation caches replay the given epoch
+    :param epoch: current epoch
+    """
+    for loader in loaders:
+        data_set = getattr(loader, 'dataset', None)
+        while isinstance(data_set, torch.utils.data.Subset):
+            data_set = data_set.dataset
+        if isinstance(data_set, AugmentationCache):
+            data_set.set_epoch(epoch)
+
+
+def batch_random_horizontal_flip(images):
+    """
+    :param images: batch of images of shape (N, C, H, W)
+    :return: images, each flipped horizontally with probability 0.5
+    """
+    flip = torch.rand(images.shape[0], device=images.device) < 0.5
+    return torch.where(flip.view(-1, 1, 1, 1), images.flip(3), images)
+
+
+class PreloadedLoader:
+    """
+    Serves batches of images held on the device by index slicing, in place of a DataLoader.
+    Images are normalized with the same operations as ToTensor and Normalize, giving identical values
+    """
+
+    def __init__(self, images, labels, mean, std, batch_size, shuffle=False, drop_last=False, batch_transforms=None):
+        """
+        :param images: uint8 images of shape (N, C, H, W)
+        :param labels: labels of shape (N,), on the same device as the images
+        :param mean: per-channel means to normalize with
+        :param std: per-channel standard deviations to normalize with
+        :param batch_size: number of samples per batch
+        :param shuffle: whether to reshuffle the samples every epoch
+        :param drop_last: whether to drop the last incomplete batch
+        :param batch_transforms: callables applied in order to each uint8 batch, before normalizing
+        """
+        self.images = images
+        self.labels = labels
+        self.mean = torch.tensor(mean, device=images.device).reshape(1, -1, 1, 1)
+        self.std = torch.tensor(std, device=images.device).reshape(1, -1, 1, 1)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.batch_transforms = [] if batch_transforms is None else batch_transforms
+
+    def __len__(self):
+        if self.drop_last:
+            return self.images.shape[0] // self.batch_size
+        return math.ceil(self.images.shape[0] / self.batch_size)
+
+    def __iter__(self):
+        order = None
+        if self.shuffle:
+            order = torch.randperm(self.images.shape[0], device=self.images.device)
+        for batch_idx in range(len(self)):
+            batch = slice(batch_idx * self.batch_size, (batch_idx + 1) * self.batch_size)
+            if order is None:
+                images, labels = self.images[batch], self.labels[batch]
+            else:
+                images, labels = self.images[order[batch]], self.labels[order[batch]]
+            for batch_transform in self.batch_transforms:
+                images = batch_transform(images)
+            yield images.float().div(255).sub(self.mean).div(self.std), labels
+
+
 def get_rms_hyperparams(args):
     if args.actfun == 'swish':
         grid_settings = [(lr_init, lr_gamma, alpha, momentum)